@@ -20,14 +20,17 @@
 from __future__ import division, absolute_import
 from __future__ import print_function
 
+from datetime import datetime
 import json
 import logging
+import signal
 import sys
 import warnings
 
 import click
 
 import feed2exec
+import feed2exec.controller
 from feed2exec.controller import FeedManager
 from feed2exec.model import (FeedConfStorage, FeedItemCacheStorage, Feed)
 import feed2exec.logging
@@ -52,10 +55,13 @@ from feed2exec.utils import slug
               help='use a different config file [default: %s]' % FeedConfStorage.guess_path())
 @click.option('--database', default=None,
               help='use a different database [default: %s]' % FeedItemCacheStorage.guess_path())
+@click.option('--seen-filter', is_flag=True,
+              help='check new items against a Bloom filter kept next to the database')
 @click.pass_context
-def main(ctx, loglevel, syslog, config, database):
+def main(ctx, loglevel, syslog, config, database, seen_filter):
     feed2exec.logging.advancedConfig(level=loglevel, syslog=syslog,
                                      logFormat='%(message)s')
+    FeedItemCacheStorage.use_filter = seen_filter
     if ctx.obj is None:
         ctx.obj = {}
     if database is None:
@@ -124,20 +130,145 @@ def rm(obj, name):
     obj['feed_manager'].conf_storage.remove(name)
 
 
-@click.command(help='fetch and process all feeds')
+@click.command(help='show the state of feeds, including failures')
+@click.option('--pattern', help='only show feeds matchin name or URL')
+@click.option('--failing', is_flag=True, help='only show failing or paused feeds')
 @click.pass_obj
-@click.option('--pattern', help='only fetch feeds matchin name or URL')
-@click.option('--parallel', help='start jobs in parallel', is_flag=True)
-@click.option('--jobs', '-j', help='start N jobs in parallel',
-              default=None, type=int, metavar='N')
-@click.option('--force', '-f', is_flag=True, help='do not check cache')
-@click.option('--catchup', '-n',
-              is_flag=True, help='tell output plugins to do nothing permanent')
-def fetch(obj, pattern, parallel, jobs, force, catchup):
+def status(obj, pattern, failing):
+    feed_manager = obj['feed_manager']
+    feed_manager.pattern = pattern
+    for state in feed_manager.status(failing=failing):
+        for key in ('last_fetch', 'last_new_item', 'next_fetch', 'last_failure',
+                    'last_checked'):
+            if state.get(key):
+                state[key] = datetime.fromtimestamp(state[key]).isoformat(timespec='seconds')
+        # irrelevant to users
+        for key in ('etag', 'last_modified', 'digest'):
+            state.pop(key, None)
+        print(json.dumps(state, indent=2, sort_keys=True))
+
+
+@click.command(help='forget failures of a feed, resuming it if it was paused')
+@click.argument('name')
+@click.pass_obj
+def resume(obj, name):
+    if name not in obj['feed_manager'].conf_storage:
+        raise click.BadParameter('feed %s not found in %s' % (name, obj['feed_manager'].conf_storage.path))
+    obj['feed_manager'].resume(name)
+
+
+@click.command(help='remove items not seen in feeds for a while from the cache')
+@click.option('--max-age', help='remove items not seen for DAYS',
+              default=feed2exec.controller.DEFAULT_GC_MAX_AGE / (24 * 60 * 60),
+              show_default=True, type=float, metavar='DAYS')
+@click.option('--keep', help='always keep the N latest items of each feed',
+              default=feed2exec.controller.DEFAULT_GC_KEEP, show_default=True,
+              type=int, metavar='N')
+@click.option('--dry-run', is_flag=True, help='only show how many items would be removed')
+@click.option('--vacuum/--no-vacuum', default=True, show_default=True,
+              help='reclaim the disk space of removed items')
+@click.pass_obj
+def gc(obj, max_age, keep, dry_run, vacuum):
+    removed = obj['feed_manager'].gc(max_age=max_age * 24 * 60 * 60, keep=keep,
+                                     dry_run=dry_run, vacuum=vacuum)
+    print(json.dumps(removed, indent=2, sort_keys=True))
+
+
+def fetch_options(func):
+    """add the options shared by the fetch and daemon commands
+
+    the settings of the feed manager are passed as extra keyword
+    arguments, to be given to :func:`setup_manager`.
+    """
+    options = [
+        click.option('--pattern', help='only fetch feeds matchin name or URL'),
+        click.option('--parallel', help='start jobs in parallel', is_flag=True),
+        click.option('--jobs', '-j', help='start N jobs in parallel',
+                     default=None, type=int, metavar='N'),
+        click.option('--fetch-jobs', help='download N feeds concurrently',
+                     default=None, type=int, metavar='N'),
+        click.option('--host-jobs', help='download at most N feeds from the same host concurrently',
+                     default=feed2exec.controller.DEFAULT_HOST_JOBS, show_default=True,
+                     type=int, metavar='N'),
+        click.option('--host-delay', help='wait SECONDS between requests to the same host',
+                     default=feed2exec.controller.DEFAULT_HOST_DELAY, show_default=True,
+                     type=float, metavar='SECONDS'),
+        click.option('--connect-timeout', help='give up connecting to a server after SECONDS',
+                     default=feed2exec.controller.DEFAULT_CONNECT_TIMEOUT, show_default=True,
+                     type=float, metavar='SECONDS'),
+        click.option('--read-timeout', help='give up waiting for data from a server after SECONDS',
+                     default=feed2exec.controller.DEFAULT_READ_TIMEOUT, show_default=True,
+                     type=float, metavar='SECONDS'),
+        click.option('--feed-timeout', help='give up downloading a feed after SECONDS',
+                     default=feed2exec.controller.DEFAULT_FEED_TIMEOUT, show_default=True,
+                     type=float, metavar='SECONDS'),
+        click.option('--worker-dispatch', is_flag=True,
+                     help='run output plugins in the parallel jobs, implies --parallel'),
+        click.option('--rewrite-redirects', is_flag=True,
+                     help='update the URL of feeds which moved permanently in the configuration'),
+        click.option('--catchup', '-n',
+                     is_flag=True, help='tell output plugins to do nothing permanent'),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+def setup_manager(obj, pattern, host_jobs, host_delay,
+                  connect_timeout, read_timeout, feed_timeout):
+    """configure the feed manager with the :func:`fetch_options`"""
     feed_manager = obj['feed_manager']
     feed_manager.pattern = pattern
+    feed_manager.host_jobs = host_jobs
+    feed_manager.host_delay = host_delay
+    feed_manager.connect_timeout = connect_timeout
+    feed_manager.read_timeout = read_timeout
+    feed_manager.feed_timeout = feed_timeout
+    return feed_manager
+
+
+@click.command(help='fetch and process all feeds')
+@click.pass_obj
+@fetch_options
+@click.option('--due', is_flag=True,
+              help='only fetch feeds due according to their schedule')
+@click.option('--deadline', type=float, metavar='SECONDS',
+              help='stop after SECONDS, leaving remaining feeds for the next run')
+@click.option('--force', '-f', is_flag=True, help='do not check cache')
+def fetch(obj, parallel, jobs, fetch_jobs, worker_dispatch, rewrite_redirects, catchup,
+          due, deadline, force, **settings):
+    feed_manager = setup_manager(obj, **settings)
     parallel = jobs or parallel
-    feed_manager.fetch(parallel, force=force, catchup=catchup)
+    feed_manager.fetch(parallel, force=force, catchup=catchup,
+                       fetch_jobs=fetch_jobs, worker_dispatch=worker_dispatch,
+                       due=due, deadline=deadline, rewrite_redirects=rewrite_redirects)
+
+
+@click.command(help='fetch feeds as they become due, until stopped')
+@click.pass_obj
+@fetch_options
+@click.option('--max-sleep', type=int, metavar='SECONDS', show_default=True,
+              default=feed2exec.controller.DEFAULT_MAX_SLEEP,
+              help='check the configuration at least this often')
+def daemon(obj, parallel, jobs, fetch_jobs, worker_dispatch, rewrite_redirects, catchup,
+           max_sleep, **settings):
+    feed_manager = setup_manager(obj, **settings)
+    parallel = jobs or parallel
+
+    def stop(signum, frame):
+        logging.info('received signal %d, stopping', signum)
+        feed_manager.stop()
+
+    def reload(signum, frame):
+        logging.info('received signal %d, reloading configuration', signum)
+        feed_manager.reload()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, reload)
+    feed_manager.serve(parallel, catchup=catchup, fetch_jobs=fetch_jobs,
+                       worker_dispatch=worker_dispatch, max_sleep=max_sleep,
+                       rewrite_redirects=rewrite_redirects)
 
 
 @click.command(help='fetch and parse a single feed')
@@ -191,6 +322,10 @@ main.add_command(add)
 main.add_command(ls)
 main.add_command(rm)
 main.add_command(fetch)
+main.add_command(daemon)
+main.add_command(status)
+main.add_command(resume)
+main.add_command(gc)
 main.add_command(import_)
 main.add_command(export)
 main.add_command(parse)
@@ -21,35 +21,140 @@ from __future__ import division, absolute_import
 from __future__ import print_function
 
 
+import collections
+import concurrent.futures
 from datetime import datetime
-try:
-    from lxml import etree
-except ImportError:  # pragma: nocover
-    # stdlib
-    import xml.etree.ElementTree as etree   # type: ignore
+import email.utils
+import hashlib
+import itertools
 import logging
 import multiprocessing
 import os
 import os.path
+import re
+import socket
+import threading
+import time
+import urllib.parse
 
 import feed2exec
 import feed2exec.plugins as plugins
 import feed2exec.utils as utils
-from feed2exec.model import Feed, FeedConfStorage, FeedContentCacheStorage, FeedItemCacheStorage
-import feedparser
-from pkg_resources import parse_version
-import requests
-import requests_file
-try:
-    import cachecontrol
-except ImportError:
-    cachecontrol = None
-
-try:
-    import dateparser
-    dateparser_enabled = True
-except ImportError:
-    dateparser_enabled = False
+from feed2exec.model import (Feed, FeedConfStorage, FeedContentCacheStorage,
+                             FeedItemCacheStorage, FeedResponse, FeedStateStorage)
+
+# requests, cachecontrol and lxml are slow to import, so they are
+# imported only when needed, see test_import_time
+
+#: default number of feeds downloaded concurrently in parallel mode
+DEFAULT_FETCH_JOBS = 10
+
+#: default number of concurrent requests to a single host, see
+#: :func:`FeedManager.fetch_many`
+DEFAULT_HOST_JOBS = 2
+
+#: default minimum delay, in seconds, between the start of two
+#: requests to a single host, see :func:`FeedManager.fetch_many`
+DEFAULT_HOST_DELAY = 0.5
+
+#: default timeouts, in seconds, to connect to a server, for each
+#: read from the server, and for the whole download of a feed
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_FEED_TIMEOUT = 120
+
+#: delay, in seconds, before fetching a feed again after its first
+#: failure. it doubles with every consecutive failure, up to
+#: BACKOFF_MAX, see :func:`FeedManager.record_failure`
+BACKOFF_MIN = 15 * 60
+BACKOFF_MAX = 7 * 24 * 60 * 60
+
+#: number of consecutive failures after which a feed is paused, if
+#: the last failure is permanent (e.g. 404 Not Found)
+MAX_FAILURES = 10
+
+#: HTTP status codes of redirects remembered between runs
+PERMANENT_REDIRECTS = (301, 308)
+
+#: HTTP errors which are not considered permanent
+TRANSIENT_STATUS = (408, 429)
+
+#: size of the chunks read from the server, in bytes
+FETCH_CHUNK_SIZE = 64 * 1024
+
+#: how many parsed feeds, per parse process, may wait for dispatch
+#: before we stop fetching new feeds in parallel mode
+PENDING_PER_PROCESS = 2
+
+#: default bounds, in seconds, of the polling interval of feeds in
+#: ``due`` mode, overridden by the ``min_interval`` and
+#: ``max_interval`` feed settings
+DEFAULT_MIN_INTERVAL = 15 * 60
+DEFAULT_MAX_INTERVAL = 24 * 60 * 60
+
+#: the polling interval is divided by this factor when new items are
+#: found, and multiplied by it otherwise
+INTERVAL_FACTOR = 1.5
+
+#: length, in seconds, of the ``sy:updatePeriod`` values
+UPDATE_PERIODS = {
+    'hourly': 60 * 60,
+    'daily': 24 * 60 * 60,
+    'weekly': 7 * 24 * 60 * 60,
+    'monthly': 30 * 24 * 60 * 60,
+    'yearly': 365 * 24 * 60 * 60,
+}
+
+#: longest time, in seconds, the daemon sleeps between two runs,
+#: even if no feed is due. this is when configuration changes (like
+#: new feeds) are noticed without a reload
+DEFAULT_MAX_SLEEP = 5 * 60
+
+#: shortest time, in seconds, the daemon sleeps between two runs, so
+#: that feeds which failed to fetch, and are therefore still due, are
+#: not retried in a loop
+MIN_SLEEP = 60
+
+#: maximum number of delivered items recorded in the cache in a
+#: single transaction. items are recorded only after their output
+#: plugin succeeds, so at most this many items may be delivered again
+#: after a crash.
+CACHE_BATCH_SIZE = 100
+
+#: number of consecutive, already seen, items after which the
+#: remaining items of a feed are skipped, as feeds are usually sorted
+#: newest first. overridden by the ``seen_limit`` feed setting, where
+#: zero processes all items, for feeds in a different order.
+DEFAULT_SEEN_LIMIT = 10
+
+#: interval, in seconds, after which all the items of a feed are
+#: looked up in the cache again, regardless of its ``seen_limit``, so
+#: that :func:`FeedManager.gc` knows which ones left the feed
+CHECK_ALL_INTERVAL = 24 * 60 * 60
+
+#: time, in seconds, after which items not seen in their feed anymore
+#: are removed from the cache by :func:`FeedManager.gc`
+DEFAULT_GC_MAX_AGE = 180 * 24 * 60 * 60
+
+#: number of latest items of each feed never removed from the cache
+#: by :func:`FeedManager.gc`. this is more than most feeds publish, so
+#: that items still in a feed are not delivered again.
+DEFAULT_GC_KEEP = 200
+
+#: bodies larger than this, in bytes, are handed to pool workers
+#: through shared memory instead of being pickled through the pool's
+#: pipe, see :class:`SharedBody`
+SHARED_BODY_SIZE = 256 * 1024
+
+#: lock shared between pool workers, see :func:`init_worker`
+LOCK = None
+
+#: number of the current run, shared with pool workers, see
+#: :func:`init_worker`
+RUN = None
+
+#: per-worker feed manager, see :func:`init_worker`
+WORKER_MANAGER = None
 
 
 class FeedManager(object):
@@ -60,7 +165,7 @@ class FeedManager(object):
     simplicity's sake, and there is no real "view" (except maybe
     `__main__`).
 
-    on intialization, a new :class:`requests.Session` object is
+    on first use, a new :class:`requests.Session` object is
     created to be used across all requests. it is passed to plugins
     during dispatch as a `session` parameter so it can be reused.
     """
@@ -69,26 +174,38 @@ class FeedManager(object):
         self.conf_path = conf_path
         self.db_path = db_path
         self.conf_storage = FeedConfStorage(self.conf_path, pattern=pattern)
-        if dateparser_enabled:
-            if parse_version(dateparser.__version__) >= parse_version('0.7.4'):
-                def dateparser_tuple_parser(string):
-                    return dateparser.parse(string).utctimetuple()
-            else:
-                # workaround bug https://github.com/scrapinghub/dateparser/issues/548
-                def dateparser_tuple_parser(string):
-                    if string.endswith('-0000'):
-                        # replace the last '-0000' with '+0000' by reversing the string twice
-                        string = string[::-1].replace('-0000'[::-1], '+0000'[::-1], 1)[::-1]
-                    return dateparser.parse(string).utctimetuple()
-            feedparser.registerDateHandler(dateparser_tuple_parser)
-
-        self._session = session or requests.Session()
-        self.sessionConfig()
+        #: maximum number of concurrent requests to a single host,
+        #: must be set before the session is created
+        self.host_jobs = DEFAULT_HOST_JOBS
+        #: minimum delay, in seconds, between the start of two
+        #: requests to a single host
+        self.host_delay = DEFAULT_HOST_DELAY
+        #: default timeouts, in seconds, to connect to a server, for
+        #: each read from the server and for the whole download of a
+        #: feed, see :func:`fetch_one`
+        self.connect_timeout = DEFAULT_CONNECT_TIMEOUT
+        self.read_timeout = DEFAULT_READ_TIMEOUT
+        self.feed_timeout = DEFAULT_FEED_TIMEOUT
+        # the session may be first used by fetch_many() threads
+        self._session_lock = threading.Lock()
+        self._session = session
+        if session is not None:
+            self.sessionConfig()
+        #: persistent pool of parse processes, see :func:`start_pool`
+        self.pool = None
+        self.pool_lock = None
+        self.pool_run = None
+        self.pool_processes = None
+        #: number of runs of :func:`fetch`
+        self.runs = 0
+        self.stopping = False
+        self.reloading = False
+        self.wakeup = threading.Event()
 
     def __repr__(self):
         return 'FeedManager(%s, %s, %s)' % (self.conf_path, self.db_path, self.pattern)
 
-    def sessionConfig(self):
+    def sessionConfig(self, session=None):
         """our custom session configuration
 
         we change the user agent and set the file:// hanlder. extra
@@ -97,35 +214,64 @@ class FeedManager(object):
 
         this can be used to configure sessions used externally, for
         example by plugins.
+
+        :param session: the :class:`requests.Session` to configure,
+                        defaults to the session of the manager
         """
-        self._session.headers.update({'User-Agent': '%s/%s'
-                                      % (feed2exec.__prog__,
-                                         feed2exec.__version__)})
-        self._session.mount('file://', requests_file.FileAdapter())
+        if session is None:
+            session = self._session
+        import requests.adapters
+        import requests_file
+        try:
+            import cachecontrol
+        except ImportError:
+            cachecontrol = None
+        session.headers.update({'User-Agent': '%s/%s'
+                                % (feed2exec.__prog__,
+                                   feed2exec.__version__)})
+        session.mount('file://', requests_file.FileAdapter())
+        # keep a connection for each concurrent request to a host,
+        # see fetch_many()
+        pool_args = {'pool_maxsize': self.host_jobs}
         if self.db_path is not None and cachecontrol is not None:
-            cache_adapter = cachecontrol.CacheControlAdapter(cache=FeedContentCacheStorage(self.db_path))
-            # assume we mount over http and https all at once so check
-            # only the latter
-            adapter = self._session.adapters.get('https://', None)
-            if hasattr(adapter, 'old_adapters'):
-                # looks like a betamax session was setup, hook ourselves behind it
-                #
-                # XXX: this doesn't actually work, as betamax will
-                # never pass the query to the cache. this is
-                # backwards, but there's no other way. see
-                # https://github.com/ionrock/cachecontrol/issues/212
-                logging.debug('appending cache adapter (%r) to existing betamax adapter (%r)', cache_adapter, adapter)
-                adapter.old_adapters['http://'] = cache_adapter
-                adapter.old_adapters['https://'] = cache_adapter
-            else:
-                logging.debug('mounting cache adapter (%r)', cache_adapter)
-                # override existing adapters to use the cache adapter instead
-                self._session.mount('http://', cache_adapter)
-                self._session.mount('https://', cache_adapter)
+            http_adapter = cachecontrol.CacheControlAdapter(cache=FeedContentCacheStorage(self.db_path),
+                                                            **pool_args)
+        else:
+            http_adapter = requests.adapters.HTTPAdapter(**pool_args)
+        # assume we mount over http and https all at once so check
+        # only the latter
+        adapter = session.adapters.get('https://', None)
+        if hasattr(adapter, 'old_adapters'):
+            # looks like a betamax session was setup, hook ourselves behind it
+            #
+            # XXX: this doesn't actually work, as betamax will
+            # never pass the query to the cache. this is
+            # backwards, but there's no other way. see
+            # https://github.com/ionrock/cachecontrol/issues/212
+            logging.debug('appending HTTP adapter (%r) to existing betamax adapter (%r)', http_adapter, adapter)
+            adapter.old_adapters['http://'] = http_adapter
+            adapter.old_adapters['https://'] = http_adapter
+        else:
+            logging.debug('mounting HTTP adapter (%r)', http_adapter)
+            # override existing adapters to use our adapter instead
+            session.mount('http://', http_adapter)
+            session.mount('https://', http_adapter)
 
     @property
     def session(self):
-        """the session property"""
+        """the session property
+
+        the session is created on first access, so that commands which
+        do not fetch anything do not need to import :mod:`requests`.
+        it is only made visible to other threads once configured.
+        """
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    import requests
+                    session = requests.Session()
+                    self.sessionConfig(session)
+                    self._session = session
         return self._session
 
     @session.setter
@@ -148,7 +294,8 @@ class FeedManager(object):
     def pattern(self, val):
         self.conf_storage.pattern = val
 
-    def fetch(self, parallel=False, force=False, catchup=False):
+    def fetch(self, parallel=False, force=False, catchup=False, fetch_jobs=None,
+              worker_dispatch=False, due=False, deadline=None, rewrite_redirects=False):
         """main entry point for the feed fetch routines.
 
         this iterates through all feeds configured in the linked
@@ -166,64 +313,437 @@ class FeedManager(object):
         :param bool catchup: set the `catchup` flag on the feed, so
                              that output plugins can avoid doing any
                              permanent changes.
+
+        :param int fetch_jobs: number of feeds to download
+                               concurrently, see :func:`fetch_many`.
+                               defaults to :data:`DEFAULT_FETCH_JOBS`
+                               in parallel mode and 1 (sequential
+                               downloads) otherwise.
+
+        :param bool worker_dispatch: run the whole pipeline (parsing,
+                                     but also filter and output
+                                     plugins and cache updates) in
+                                     the worker processes instead of
+                                     dispatching in this process,
+                                     see :func:`parse_and_dispatch`.
+                                     implies ``parallel``.
+
+        :param bool due: only fetch feeds that are due according to
+                         their schedule, see :func:`schedule`.
+
+        :param float deadline: stop after this many seconds. downloads
+                               still running are aborted and feeds not
+                               processed yet are left for the next
+                               run. feeds already downloaded are still
+                               processed, as plugins cannot be
+                               interrupted safely.
+
+        :param bool rewrite_redirects: replace the URL of feeds which
+                                       moved permanently in the
+                                       configuration file, at the end
+                                       of the run, see
+                                       :func:`rewrite_urls`
         """
+        if deadline is not None:
+            deadline = time.monotonic() + deadline
+        self.runs += 1
+        FeedItemCacheStorage.start_run(self.runs)
         logging.debug('looking for feeds %s in %s', self.pattern, self.conf_storage)
+        if worker_dispatch and not parallel:
+            parallel = True
+        if fetch_jobs is None:
+            fetch_jobs = DEFAULT_FETCH_JOBS if parallel else 1
+        own_pool = False
         if parallel:
-            lock = multiprocessing.Lock()
+            if self.pool is None:
+                processes = None
+                if isinstance(parallel, int):
+                    processes = parallel
+                self.start_pool(processes, worker_dispatch)
+                own_pool = True
+            pool, lock = self.pool, self.pool_lock
+            self.pool_run.value = self.runs
+            max_pending = PENDING_PER_PROCESS * (self.pool_processes or os.cpu_count() or 1)
+        # XXX: this is dirty. iterator/getters/??? should return
+        # the right thing? or will that break an eventual editor?
+        # maybe autocommit is a bad idea in the first place..
+        feeds = [Feed(feed['name'], feed) for feed in self.conf_storage]
+        if due:
+            now = time.time()
+            due_feeds = [feed for feed in feeds if self.is_due(feed, now)]
+            logging.info('%d feeds out of %d are due', len(due_feeds), len(feeds))
+            feeds = due_feeds
+        elif not force:
+            now = time.time()
+            ready = [feed for feed in feeds if not self.in_backoff(feed, now)]
+            if len(ready) < len(feeds):
+                logging.info('skipping %d failing feeds until their next attempt',
+                             len(feeds) - len(ready))
+            feeds = ready
+        pending = []
+        redirects = []
+        try:
+            for feed, body in self.fetch_many(feeds, jobs=fetch_jobs, force=force,
+                                              deadline=deadline):
+                # feeds left are not marked as fetched, so they will be
+                # due on the next run
+                if self.stopping:
+                    logging.info('stopping, skipping remaining feeds')
+                    break
+                if deadline is not None and time.monotonic() > deadline:
+                    logging.warning('deadline reached, skipping remaining feeds')
+                    break
+                if rewrite_redirects and feed.state_updates.get('redirect_url'):
+                    redirects.append((feed['name'], feed['url'], feed.state_updates['redirect_url']))
+                if body is None:
+                    if feed.hints.get('unchanged'):
+                        self.schedule(feed)
+                    # unchanged feeds may have new headers
+                    self.save_state(feed)
+                    continue
+                if catchup:
+                    feed['catchup'] = catchup
+                if parallel:
+                    # if this fails silently, use plain apply() to see errors
+                    if len(body) > SHARED_BODY_SIZE:
+                        body = SharedBody.create(body)
+                    if worker_dispatch:
+                        result = pool.apply_async(parse_and_dispatch, (feed, body, force))
+                    else:
+                        result = pool.apply_async(parse_new, (feed, body, self.db_path, force))
+                    pending.append((feed, result, body))
+                    self.dispatch_ready(pending, lock, force, max_pending, worker_dispatch)
+                else:
+                    global LOCK
+                    LOCK = None
+                    data = feed.parse(body, lazy=True)
+                    if data:
+                        self.dispatch(feed, data, None, force)
+                    self.save_state(feed)
+            if parallel:
+                self.dispatch_ready(pending, lock, force, 0, worker_dispatch)
+        finally:
+            # bodies of results abandoned after an error
+            for entry in pending:
+                free_body(entry[2])
+        if own_pool:
+            self.close_pool()
+        logging.info('%d feeds processed', len(feeds))
+        if redirects:
+            self.rewrite_urls(redirects)
+
+    def rewrite_urls(self, redirects):
+        """replace the URL of feeds in the configuration file
+
+        all changes are written at once, and the configuration is
+        then reloaded.
+
+        :param list redirects: ``(name, old, new)`` tuples. feeds whose
+                               URL is not ``old`` anymore in the
+                               configuration file are left alone.
+        """
+        # read the file again, in case it was modified since we started
+        conf_storage = FeedConfStorage(self.conf_path)
+        changes = []
+        for name, old, new in redirects:
+            if name in conf_storage and conf_storage[name].get('url') == old:
+                logging.info('changing URL of feed %s from %s to %s', name, old, new)
+                changes.append((name, 'url', new))
+        if changes:
+            conf_storage.set_many(changes)
+            self.reload_config()
+
+    def start_pool(self, processes=None, worker_dispatch=False):
+        """start the pool of processes used to parse feeds
+
+        the pool is kept across :func:`fetch` calls until
+        :func:`close_pool` is called, so that a long running process
+        (see :func:`serve`) does not start new processes, and
+        reimport plugins in them, on every run. otherwise,
+        :func:`fetch` starts a pool for a single run.
+
+        :param int processes: number of processes, defaults to the
+                              number of CPUs
+
+        :param bool worker_dispatch: setup workers to dispatch feeds
+                                     as well, see
+                                     :func:`parse_and_dispatch`
+        """
+        self.pool_lock = multiprocessing.Lock()
+        self.pool_run = multiprocessing.RawValue('L', self.runs)
+        if worker_dispatch:
+            initargs = (self.pool_lock, self.conf_path, self.db_path, self.pool_run)
+        else:
+            initargs = (self.pool_lock, None, None, self.pool_run)
+        self.pool = multiprocessing.Pool(processes=processes,
+                                         initializer=init_worker,
+                                         initargs=initargs)
+        self.pool_processes = processes
+
+    def close_pool(self):
+        """wait for the pool processes to finish and stop them"""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def serve(self, parallel=False, catchup=False, fetch_jobs=None,
+              worker_dispatch=False, max_sleep=DEFAULT_MAX_SLEEP,
+              rewrite_redirects=False):
+        """fetch feeds as they become due, until :func:`stop` is called
+
+        this is the main loop of the ``daemon`` command. instead of
+        starting a new process regularly, the same session (and its
+        connection pools), database connections, plugins and, in
+        parallel mode, worker processes are reused for every run.
+
+        each run calls :func:`fetch` in ``due`` mode, then sleeps
+        until the next feed is due (see :func:`next_due`), for at
+        most ``max_sleep`` seconds and at least :data:`MIN_SLEEP`
+        seconds. the configuration is reloaded
+        before the next run when :func:`reload` is called.
+
+        parameters are passed to :func:`fetch`.
+        """
+        if worker_dispatch and not parallel:
+            parallel = True
+        if parallel and self.pool is None:
             processes = None
             if isinstance(parallel, int):
                 processes = parallel
+            self.start_pool(processes, worker_dispatch)
+        try:
+            while not self.stopping:
+                if self.reloading:
+                    self.reload_config()
+                self.fetch(parallel, catchup=catchup, fetch_jobs=fetch_jobs,
+                           worker_dispatch=worker_dispatch, due=True,
+                           rewrite_redirects=rewrite_redirects)
+                if self.stopping or self.reloading:
+                    continue
+                delay = max(min(self.next_due(), max_sleep), MIN_SLEEP)
+                logging.info('sleeping %d seconds until next run', delay)
+                self.wakeup.wait(delay)
+                self.wakeup.clear()
+        finally:
+            self.close_pool()
+        logging.info('daemon stopped')
+
+    def stop(self):
+        """ask :func:`serve` to stop after the feeds being processed
+
+        this is safe to call from a signal handler.
+        """
+        self.stopping = True
+        self.wakeup.set()
 
-            def init_global_lock(lock):
-                """setup a global lock across pool threads
-
-                this is necessary because Lock objects are not
-                serializable so we can't pass them as arguments. An
-                alternative pattern is to have a `Manager` process and
-                use IPC for locking.
-
-                cargo-culted from this `stackoverflow answer
-                <https://stackoverflow.com/a/25558333/1174784>`_
-
-                """
-                global LOCK
-                LOCK = lock
-
-            pool = multiprocessing.Pool(processes=processes,
-                                        initializer=init_global_lock,
-                                        initargs=(lock,))
-        data_results = []
-        i = -1
-        for i, feed in enumerate(self.conf_storage):
-            logging.debug('found feed in DB: %s', dict(feed))
-            # XXX: this is dirty. iterator/getters/??? should return
-            # the right thing? or will that break an eventual editor?
-            # maybe autocommit is a bad idea in the first place..
-            feed = Feed(feed['name'], feed)
-            body = self.fetch_one(feed)
-            if body is None:
+    def reload(self):
+        """ask :func:`serve` to reload the configuration and run again
+
+        this is safe to call from a signal handler.
+        """
+        self.reloading = True
+        self.wakeup.set()
+
+    def reload_config(self):
+        """read the configuration file again"""
+        logging.info('reloading configuration from %s', self.conf_path)
+        self.reloading = False
+        self.conf_storage = FeedConfStorage(self.conf_path, pattern=self.pattern)
+
+    def next_due(self, now=None):
+        """number of seconds until the next feed is due
+
+        this is zero if a feed is already due, see :func:`is_due`.
+        """
+        if now is None:
+            now = time.time()
+        delays = []
+        for feed in self.conf_storage:
+            if self.db_path is None or feed.get('pause'):
                 continue
-            if catchup:
-                feed['catchup'] = catchup
-            if parallel:
-                # if this fails silently, use plain apply() to see errors
-                data_results.append((feed, pool.apply_async(feed.parse, (body,))))
-            else:
-                global LOCK
-                LOCK = None
-                data = feed.parse(body)
-                if data:
-                    self.dispatch(feed, data, None, force)
-        if parallel:
-            for feed, result in data_results:
-                data = result.get()
-                if data:
+            state = FeedStateStorage(self.db_path, feed['name']).load()
+            if state.get('paused'):
+                continue
+            next_fetch = state.get('next_fetch')
+            if next_fetch is None:
+                return 0
+            delays.append(next_fetch - now)
+        return max(min(delays, default=DEFAULT_MAX_INTERVAL), 0)
+
+    def dispatch_ready(self, pending, lock, force, max_pending, worker_dispatch=False):
+        """dispatch feeds parsed in the background, as they complete
+
+        this looks through the ``pending`` list of ``(feed, result,
+        body)`` tuples, where ``result`` is the
+        :class:`multiprocessing.pool.AsyncResult` of a
+        :func:`feed2exec.model.Feed.parse` call on ``body``, frees the
+        body if it is a :class:`SharedBody`, and calls
+        :func:`dispatch` on those that are ready, removing them from
+        the list, and saves their state with :func:`save_state`.
+
+        if more than ``max_pending`` results are still waiting, this
+        blocks until enough of them are completed. this keeps a bound
+        on the number of parsed feeds kept in memory and provides
+        backpressure on the fetch stage. with ``max_pending`` set to
+        zero, this waits for all results.
+
+        with ``worker_dispatch``, results are instead those of
+        :func:`parse_and_dispatch`: the feed was already dispatched in
+        the worker, and only the state updates it returns are merged
+        in the feed.
+        """
+        while pending:
+            ready = [entry for entry in pending if entry[1].ready()]
+            if not ready:
+                if len(pending) <= max_pending:
+                    break
+                # wait for the oldest result, then look for others
+                pending[0][1].wait()
+                continue
+            for entry in ready:
+                pending.remove(entry)
+                feed, result, body = entry
+                try:
+                    data = result.get()
+                finally:
+                    free_body(body)
+                if worker_dispatch:
+                    feed.state_updates.update(data)
+                elif data:
                     self.dispatch(feed, data, lock, force)
-            pool.close()
-            pool.join()
-        logging.info('%d feeds processed', i+1)
+                self.save_state(feed)
+
+    def fetch_many(self, feeds, jobs=1, force=False, deadline=None):
+        """fetch multiple feeds concurrently
+
+        this calls :func:`fetch_one` on each feed from a pool of
+        ``jobs`` threads, as network latency, and not CPU, is usually
+        the bottleneck when downloading feeds. results are yielded
+        as soon as they complete, so that the caller can start
+        parsing a feed while the others are still being downloaded.
+
+        to avoid hammering servers hosting many feeds, at most
+        :attr:`host_jobs` requests are sent to the same host at once,
+        and they are spaced by at least :attr:`host_delay`
+        seconds. feeds from a busy host are postponed, and feeds from
+        other hosts are fetched meanwhile.
+
+        with a single job, feeds are fetched sequentially, in order,
+        in the calling thread.
+
+        :param list feeds: the :class:`feed2exec.model.Feed` objects
+                           to fetch
+
+        :param int jobs: the maximum number of requests in flight, or
+                         completed but not yet consumed by the caller
+
+        :param bool force: passed to :func:`fetch_one`
+
+        :param float deadline: passed to :func:`fetch_one`. no new
+                               download is started after that time
 
-    def fetch_one(self, feed):
+        :return: a generator of ``(feed, body)`` tuples, in order of
+                 completion, where ``body`` is the return value of
+                 :func:`fetch_one`
+        """
+        if jobs is None or jobs <= 1:
+            for feed in feeds:
+                if deadline is not None and time.monotonic() > deadline:
+                    return
+                logging.debug('found feed in DB: %s', dict(feed))
+                yield feed, self.fetch_one(feed, force=force, deadline=deadline)
+            return
+        feeds = iter(feeds)
+        # requests in flight, feeds waiting for their host to be
+        # available, by host, and when the last request to each host
+        # was sent
+        active = collections.Counter()
+        postponed = collections.OrderedDict()
+        last_start = {}
+
+        def ready_at(host):
+            """when the next request to the host can start, None if busy"""
+            if not host:
+                # local files
+                return 0
+            if active[host] >= self.host_jobs:
+                return None
+            return last_start.get(host, 0) + self.host_delay
+
+        def pick(now):
+            """next feed which can be fetched now, postponing others"""
+            for host, queue in postponed.items():
+                start = ready_at(host)
+                if start is not None and start <= now:
+                    feed = queue.popleft()
+                    if not queue:
+                        del postponed[host]
+                    return feed
+            for feed in feeds:
+                logging.debug('found feed in DB: %s', dict(feed))
+                host = feed_host(feed)
+                start = ready_at(host)
+                if host not in postponed and start is not None and start <= now:
+                    return feed
+                postponed.setdefault(host, collections.deque()).append(feed)
+            return None
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        try:
+            futures = {}
+
+            def submit(count):
+                now = time.monotonic()
+                if deadline is not None and now > deadline:
+                    postponed.clear()
+                    return
+                for _ in range(count):
+                    feed = pick(now)
+                    if feed is None:
+                        break
+                    host = feed_host(feed)
+                    active[host] += 1
+                    last_start[host] = now
+                    futures[executor.submit(self.fetch_one, feed, force, deadline)] = feed
+
+            submit(jobs)
+            while futures or postponed:
+                timeout = None
+                if len(futures) < jobs:
+                    # wake up when the next postponed host is available
+                    starts = [start for start in map(ready_at, postponed) if start is not None]
+                    if starts:
+                        timeout = max(min(starts) - time.monotonic(), 0)
+                if futures:
+                    if deadline is not None:
+                        remaining = max(deadline - time.monotonic(), 0)
+                        timeout = remaining if timeout is None else min(timeout, remaining)
+                    done, _ = concurrent.futures.wait(futures, timeout=timeout,
+                                                      return_when=concurrent.futures.FIRST_COMPLETED)
+                    if not done and deadline is not None and time.monotonic() > deadline:
+                        logging.warning('deadline reached, abandoning %d downloads', len(futures))
+                        return
+                else:
+                    time.sleep(timeout)
+                    done = ()
+                for future in done:
+                    feed = futures.pop(future)
+                    active[feed_host(feed)] -= 1
+                    # only queue new requests when a result is
+                    # consumed, so we do not accumulate bodies in
+                    # memory if the caller is slower than the network
+                    submit(jobs - len(futures))
+                    yield feed, future.result()
+                submit(jobs - len(futures))
+        finally:
+            # downloads still running at the deadline are aborted by
+            # fetch_one(), but do not wait for them, in case they are
+            # stuck somewhere else
+            expired = deadline is not None and time.monotonic() > deadline
+            executor.shutdown(wait=not expired)
+
+    def fetch_one(self, feed, force=False, deadline=None):
         """fetch the feed content and return the body, in binary
 
         This will call :func:`logging.warning` for exceptions
@@ -234,32 +754,351 @@ class FeedManager(object):
         Other exceptions raised from :mod:`requests.exceptions` (like
         TooManyRedirects or HTTPError but basically any other exception)
         may be a configuration error or a more permanent failure so will
-        be signaled with :func:`logging.error`.
+        be signaled with :func:`logging.error`. All failures are
+        recorded with :func:`record_failure`.
+
+        The ``ETag`` and ``Last-Modified`` headers of the last response
+        are sent back to the server (as ``If-None-Match`` and
+        ``If-Modified-Since``) so it can tell us the feed has not
+        changed. The new headers are stored in the feed's
+        ``state_updates``, to be saved with :func:`save_state` once the
+        feed is processed.
+
+        When the feed URL permanently redirects (``301 Moved
+        Permanently`` or ``308 Permanent Redirect``) elsewhere, the
+        new URL is remembered and fetched directly the next time, until
+        it fails with an HTTP error.
+
+        Since many servers ignore those headers, a digest of the body
+        is also compared with the one from the last fetch, and
+        unchanged feeds are skipped as well.
+
+        The metadata of the response is kept in the ``response``
+        attribute of the feed, see :class:`feed2exec.model.FeedResponse`.
+
+        The connection and each read from the server are limited by
+        the ``connect_timeout`` and ``read_timeout`` settings of the
+        feed, and the whole download by its ``feed_timeout``
+        setting, even if the server keeps sending data slowly, see
+        :func:`download`. They default to the :attr:`connect_timeout`,
+        :attr:`read_timeout` and :attr:`feed_timeout` attributes of
+        the manager.
+
+        :param bool force: ignore the saved headers and digest and
+                           always return the full feed
+
+        :param float deadline: abort the download if it is not
+                               finished at this :func:`time.monotonic`
+                               time
 
         this will return the body on success or None on failure and cached entries
         """
+        import requests
         if feed.get('pause'):
             logging.info('feed %s is paused, skipping', feed['name'])
             return None
-        logging.info('fetching feed %s', feed['url'])
+        headers = {}
+        state = {}
+        if self.db_path is not None:
+            state = FeedStateStorage(self.db_path, feed['name']).load()
+        if state.get('paused'):
+            logging.info('feed %s was paused after too many failures (%s), skipping',
+                         feed['name'], state['paused'])
+            return None
+        now = time.time()
+        if self.db_path is not None and (state.get('last_checked') or 0) < now - CHECK_ALL_INTERVAL:
+            # recorded as the last check if all items are looked up, see unseen()
+            feed.hints['check_all'] = now
+        url = feed['url']
+        if state.get('redirect_url') and state.get('redirect_from') == url:
+            url = state['redirect_url']
+        logging.info('fetching feed %s', url)
+        if not force:
+            if state.get('etag'):
+                headers['If-None-Match'] = state['etag']
+            if state.get('last_modified'):
+                headers['If-Modified-Since'] = state['last_modified']
+        connect_timeout = feed.getnumber('connect_timeout', self.connect_timeout, positive=True)
+        read_timeout = feed.getnumber('read_timeout', self.read_timeout, positive=True)
+        feed_deadline = time.monotonic() + feed.getnumber('feed_timeout', self.feed_timeout,
+                                                          positive=True)
+        if deadline is not None:
+            feed_deadline = min(feed_deadline, deadline)
         try:
-            resp = self.session.get(feed['url'])
-            if getattr(resp, 'from_cache', False):
-                return None
-            body = resp.content
+            resp = self.session.get(url, headers=headers, stream=True,
+                                    timeout=(connect_timeout, read_timeout))
+            # release the connection on every path, so it is reused
+            with resp:
+                feed.hints.update(header_hints(resp.headers))
+                if resp.status_code >= 400:
+                    try:
+                        # read the error page, so the connection is kept alive
+                        download(resp, feed_deadline)
+                    except requests.exceptions.RequestException:
+                        pass
+                resp.raise_for_status()
+                target = permanent_redirect(resp) or url
+                if target != feed['url']:
+                    if target != state.get('redirect_url'):
+                        logging.info('feed %s moved permanently to %s', feed['name'], target)
+                    feed.state_updates.update(redirect_from=feed['url'], redirect_url=target)
+                if state.get('failures'):
+                    # overridden by record_failure() if the download fails
+                    feed.state_updates.update(failures=0, last_error=None)
+                if getattr(resp, 'from_cache', False):
+                    feed.hints['unchanged'] = True
+                    return None
+                if resp.status_code == requests.codes.not_modified:
+                    logging.info('feed %s not modified since last fetch', feed['name'])
+                    feed.hints['unchanged'] = True
+                    # there is no body, but this marks the response
+                    # as consumed so the connection can be kept alive
+                    resp.content
+                    return None
+                body = download(resp, feed_deadline)
+            feed.response = FeedResponse(url=resp.url, status=resp.status_code,
+                                         headers=dict((key.lower(), value)
+                                                      for key, value in resp.headers.items()),
+                                         encoding=resp.encoding)
         except (requests.exceptions.Timeout,
                 requests.exceptions.ConnectionError) as e:
-            # XXX: we should count those and warn after a few
-            # occurrences
             logging.warning('timeout while fetching feed %s at %s: %s',
-                            feed['name'], feed['url'], e)
+                            feed['name'], url, e)
+            self.record_failure(feed, state, e)
+            return None
+        except requests.exceptions.HTTPError as e:
+            status = e.response.status_code
+            logging.error('error while fetching feed %s at %s: %s',
+                          feed['name'], url, e)
+            if url != feed['url']:
+                logging.info('forgetting redirect of feed %s to %s', feed['name'], url)
+                feed.state_updates.update(redirect_from=None, redirect_url=None)
+            self.record_failure(feed, state, e,
+                                permanent=status < 500 and status not in TRANSIENT_STATUS,
+                                gone=status == requests.codes.gone)
             return None
         except requests.exceptions.RequestException as e:
             logging.error('exception while fetching feed %s at %s: %s',
-                          feed['name'], feed['url'], e)
+                          feed['name'], url, e)
+            self.record_failure(feed, state, e, permanent=True)
+            return None
+        digest = hashlib.sha256(body).hexdigest()
+        feed.state_updates.update(etag=resp.headers.get('ETag'),
+                                  last_modified=resp.headers.get('Last-Modified'),
+                                  digest=digest)
+        if not force and digest == state.get('digest'):
+            logging.info('feed %s unchanged since last fetch', feed['name'])
+            feed.hints['unchanged'] = True
             return None
         return body
 
+    def record_failure(self, feed, state, error, permanent=False, gone=False):
+        """remember that fetching the feed failed, and back off
+
+        consecutive failures are counted, and the feed is not fetched
+        again before a delay that doubles with every failure, from
+        :data:`BACKOFF_MIN` up to :data:`BACKOFF_MAX`, or longer if
+        the server asked for it with ``Retry-After``. the feed is
+        paused if the server says it is ``gone`` or after
+        :data:`MAX_FAILURES` failures, if the last one is
+        ``permanent``. paused feeds are skipped until :func:`resume`
+        is called.
+
+        the result is recorded in the ``state_updates`` of the feed.
+
+        :param dict state: the state of the feed before this fetch
+
+        :param Exception error: what went wrong
+        """
+        if self.db_path is None:
+            return
+        failures = (state.get('failures') or 0) + 1
+        now = time.time()
+        delay = min(BACKOFF_MIN * 2 ** (failures - 1), BACKOFF_MAX)
+        # e.g. 429 Too Many Requests or 503 Service Unavailable
+        delay = max(delay, feed.hints.get('retry_after', 0))
+        feed.state_updates.update(failures=failures, last_error=str(error),
+                                  last_failure=now, next_fetch=now + delay)
+        if gone or (permanent and failures >= MAX_FAILURES):
+            reason = 'gone' if gone else '%d failures' % failures
+            logging.warning('pausing feed %s (%s): %s', feed['name'], reason, error)
+            feed.state_updates['paused'] = reason
+        else:
+            logging.debug('feed %s failed %d times, retrying in %d seconds',
+                          feed['name'], failures, delay)
+
+    def resume(self, name):
+        """forget the failures of a feed, and resume it if it was paused"""
+        FeedStateStorage(self.db_path, name).save(failures=0, last_error=None,
+                                                  paused=None, next_fetch=None)
+
+    def status(self, failing=False):
+        """report the state of the configured feeds
+
+        :param bool failing: only report feeds which failed on their
+                             last fetch, or were paused
+
+        :return: a generator of dicts with the ``name`` and ``url`` of
+                 each feed and its state, see
+                 :class:`feed2exec.model.FeedStateStorage`
+        """
+        for feed in self.conf_storage:
+            state = {}
+            if self.db_path is not None:
+                state = FeedStateStorage(self.db_path, feed['name']).load()
+            if failing and not (state.get('failures') or state.get('paused')):
+                continue
+            state.update(name=feed['name'], url=feed['url'])
+            yield state
+
+    def gc(self, max_age=DEFAULT_GC_MAX_AGE, keep=DEFAULT_GC_KEEP,
+           dry_run=False, vacuum=True):
+        """remove items not seen in their feed for a while from the cache
+
+        to avoid delivering items again if they show up in the feed
+        anyways, the ``keep`` latest items of each feed are never
+        removed, and neither are the items of feeds not fetched
+        successfully within ``max_age``, e.g. failing or paused
+        feeds. other items of feeds removed from the configuration
+        are removed once they are older than ``max_age``. nothing is
+        removed if no feed is configured at all, as this is more
+        likely the wrong configuration file than an intent to forget
+        everything.
+
+        items are only marked as seen when they are looked up in the
+        cache, which does not happen for unchanged feeds, or for items
+        past the ``seen_limit`` of the feed, see :func:`unseen`. so
+        only the items missing from the last time all the items of the
+        feed were looked up (``last_checked``, at most once every
+        :data:`CHECK_ALL_INTERVAL`) are removed.
+
+        the database is then vacuumed to reclaim disk space.
+
+        :param float max_age: remove items last seen more than that
+                              many seconds ago
+
+        :param int keep: number of latest items kept for each feed
+
+        :param bool dry_run: do not remove anything
+
+        :param bool vacuum: vacuum the database if items were removed
+
+        :return dict: the number of items removed, or that would be
+                      removed with ``dry_run``, for each feed
+        """
+        cutoff = time.time() - max_age
+        configured = set(self.conf_storage.sections())
+        removed = {}
+        if not configured:
+            logging.warning('no feed configured in %s, not removing anything', self.conf_path)
+            return removed
+        for name in FeedItemCacheStorage(self.db_path).names():
+            cache = FeedItemCacheStorage(self.db_path, feed=name)
+            state = FeedStateStorage(self.db_path, name).load()
+            if name not in configured:
+                count = cache.prune(cutoff, keep, dry_run)
+            elif (state.get('last_fetch') or 0) < cutoff:
+                logging.info('feed %s not fetched recently, keeping its items', name)
+                continue
+            else:
+                # items still in the feed were seen at the last check,
+                # up to the resolution of last_seen
+                checked = (state.get('last_checked') or 0) - cache.last_seen_resolution
+                count = cache.prune(min(cutoff, checked), keep, dry_run)
+            if count:
+                logging.info('%d items of feed %s not seen recently', count, name)
+                removed[name] = count
+        if removed and vacuum and not dry_run:
+            size = os.path.getsize(self.db_path)
+            FeedItemCacheStorage(self.db_path).vacuum()
+            logging.info('database vacuumed from %d to %d bytes',
+                         size, os.path.getsize(self.db_path))
+        return removed
+
+    def in_backoff(self, feed, now=None):
+        """check if the feed failed and should not be fetched yet
+
+        see :func:`record_failure`.
+        """
+        if self.db_path is None:
+            return False
+        if now is None:
+            now = time.time()
+        state = FeedStateStorage(self.db_path, feed['name']).load()
+        return bool(state.get('failures')) and (state.get('next_fetch') or 0) > now
+
+    def save_state(self, feed):
+        """save the feed state changes recorded while processing it
+
+        this is called only once the feed was completely processed,
+        so that the feed is fetched again if we crash before, instead
+        of being skipped because the server says it was not modified.
+        """
+        if self.db_path is not None and feed.state_updates:
+            FeedStateStorage(self.db_path, feed['name']).save(**feed.state_updates)
+            feed.state_updates = {}
+
+    def is_due(self, feed, now=None):
+        """check if the feed should be fetched according to its schedule
+
+        feeds never fetched before are always due, and feeds paused
+        after too many failures never are.
+        """
+        if self.db_path is None:
+            return True
+        if now is None:
+            now = time.time()
+        state = FeedStateStorage(self.db_path, feed['name']).load()
+        if state.get('paused'):
+            return False
+        next_fetch = state.get('next_fetch')
+        return next_fetch is None or next_fetch <= now
+
+    def schedule(self, feed, new_items=0, data=None):
+        """compute when the feed should be fetched next
+
+        this adapts the polling interval of the feed to how often it
+        changes: the interval is divided by :data:`INTERVAL_FACTOR`
+        when new items were found and multiplied by it otherwise,
+        within the ``min_interval`` and ``max_interval`` settings of
+        the feed (:data:`DEFAULT_MIN_INTERVAL` and
+        :data:`DEFAULT_MAX_INTERVAL` by default).
+
+        the interval is never shorter than what the publisher asks
+        for, through the ``Cache-Control: max-age`` or ``Expires``
+        headers or the ``<ttl>`` and ``sy:updatePeriod`` feed
+        elements, up to ``max_interval``. a ``Retry-After`` header delays the next
+        fetch, but not the following ones.
+
+        the result is recorded in the ``state_updates`` of the feed.
+
+        :param int new_items: number of new items found in the feed
+
+        :param dict data: the parsed feed, to look for hints in
+        """
+        if self.db_path is None:
+            return
+        now = time.time()
+        state = FeedStateStorage(self.db_path, feed['name']).load()
+        min_interval = feed.getnumber('min_interval', DEFAULT_MIN_INTERVAL)
+        max_interval = feed.getnumber('max_interval', DEFAULT_MAX_INTERVAL)
+        interval = state.get('interval') or min_interval
+        if new_items:
+            interval /= INTERVAL_FACTOR
+            feed.state_updates['last_new_item'] = now
+        else:
+            interval *= INTERVAL_FACTOR
+        hints = dict(feed.hints)
+        if data is not None:
+            hints.update(feed_hints(data))
+        interval = max(interval, min_interval, hints.get('max_age', 0), hints.get('ttl', 0))
+        interval = min(interval, max_interval)
+        delay = max(interval, hints.get('retry_after', 0))
+        logging.debug('feed %s: %d new items, next fetch in %d seconds',
+                      feed['name'], new_items, delay)
+        feed.state_updates.update(last_fetch=now, interval=interval,
+                                  next_fetch=now + delay)
+
     def dispatch(self, feed, data, lock=None, force=False):
         '''process parsed entries and execute plugins
 
@@ -271,7 +1110,17 @@ class FeedManager(object):
         :func:`feed2exec.plugins.filter`). It also updates the cache
         with the found items if the ``output`` plugin succeeds
         (returns True) and if the ``filter`` plugin doesn't set the
-        ``skip`` element in the feed item.
+        ``skip`` element in the feed item. If the ``output`` plugin
+        returns False, the validators and digest of the feed are
+        forgotten, so that the feed is processed again on the next
+        run. this does not apply to feeds without ``output`` plugin.
+
+        Filters are run on batches of items first, so that the cache
+        can be checked for all remaining items of a batch in a single
+        query (see :func:`feed2exec.model.FeedItemCacheStorage.seen`),
+        then the output plugins are called on new items. Processing
+        stops after ``seen_limit`` consecutive items were already seen,
+        see :func:`unseen`.
 
         :param object lock: a :class:`multiprocessing.Lock` object
                             previously initialized. if None, the global
@@ -287,28 +1136,82 @@ class FeedManager(object):
         '''
         logging.debug('dispatching plugins for items parsed from %s', feed['name'])
         cache = FeedItemCacheStorage(self.db_path, feed=feed['name'])
-        for item in data['entries']:
-            feed.normalize(item=item)
+        seen = set()
+        delivered = []
+        new_items = 0
+        refused = False
+        try:
+            for item in unseen(feed, self.filtered_items(feed, data['entries'], lock),
+                               cache, seen, force):
+                guid = item['id']
+                logging.debug('new item %s <%s>', guid, item['link'])
+                if plugins.output(feed, item, session=self.session, lock=lock) is False:
+                    # also returned for feeds without output plugin
+                    refused = refused or bool(feed.get('output'))
+                elif not force:
+                    new_items += 1
+                    delivered.append(guid)
+                    # in case the GUID is repeated in the feed
+                    seen.add(guid)
+                    if len(delivered) >= CACHE_BATCH_SIZE:
+                        self.cache_add(cache, delivered, lock)
+                        delivered = []
+        finally:
+            # also record items delivered before a failure
+            self.cache_add(cache, delivered, lock)
+        if refused:
+            # the output plugin will be called again for the items it
+            # refused on the next run only if the feed is not skipped
+            # as unchanged, see fetch_one()
+            logging.info('some items of feed %s were not delivered, will retry', feed['name'])
+            feed.state_updates.update(etag=None, last_modified=None, digest=None)
+        self.schedule(feed, new_items, data)
+        return data
+
+    def filtered_items(self, feed, entries, lock=None):
+        """normalize the entries and run the filter plugin on them
+
+        :return: a generator of the items not skipped by the filter
+        """
+        for item in normalized(feed, entries):
             plugins.filter(feed=feed, item=item, session=self.session, lock=lock)
             if item.get('skip'):
                 logging.info('item %s of feed %s filtered out',
                              item.get('title'), feed.get('name'))
                 continue
-            guid = item['id']
-            if not force and guid in cache:
-                logging.debug('item %s already seen', guid)
-            else:
-                logging.debug('new item %s <%s>', guid, item['link'])
-                if plugins.output(feed, item, session=self.session, lock=lock) is not False and not force:  # noqa
-                    if lock:
-                        lock.acquire()
+            yield item
+
+    def cache_add(self, cache, guids, lock=None):
+        """mark the given GUIDs as seen, in a single transaction
+
+        :param cache: the :class:`feed2exec.model.FeedItemCacheStorage`
+                      to add the GUIDs to
+
+        :param list guids: GUIDs of items that were successfully
+                           processed by output plugins
+
+        :param object lock: a :class:`multiprocessing.Lock` held
+                            during the transaction, if any
+        """
+        if not guids:
+            return
+        if lock:
+            lock.acquire()
+        try:
+            with cache.transaction():
+                for guid in guids:
                     cache.add(guid)
-                    if lock:
-                        lock.release()
-        return data
+        finally:
+            if lock:
+                lock.release()
 
     def opml_import(self, opmlfile):
         """import a file stream as an OPML feed in the feed storage"""
+        try:
+            from lxml import etree
+        except ImportError:  # pragma: nocover
+            # stdlib
+            import xml.etree.ElementTree as etree   # type: ignore
         folders = []
         for (event, node) in etree.iterparse(opmlfile, ['start', 'end']):
             if node.tag != 'outline':
@@ -354,3 +1257,422 @@ class FeedManager(object):
                                  date=datetime.now(),
                                  body=body)
         path.write(output.encode('utf-8'))
+
+
+class SharedBody(object):
+    """a feed body handed to a pool worker through shared memory
+
+    only the name of the :class:`multiprocessing.shared_memory.SharedMemory`
+    segment holding the body is pickled, so that large bodies do not
+    go through the pipe of the pool. the segment is only mapped by the
+    worker, see :func:`read`, and freed by the parent process once
+    the worker is done with it, or failed, see :func:`unlink`.
+
+    segments are not registered with the resource tracker while they
+    are mapped, as it would otherwise report them as leaked.
+
+    this requires Python 3.8: :func:`create` otherwise returns the
+    body as is, to be pickled.
+    """
+
+    def __init__(self, name, size):
+        #: name of the shared memory segment
+        self.name = name
+        #: size of the body, as the segment may be larger
+        self.size = size
+
+    @staticmethod
+    def open(name=None, size=0):
+        """map an existing shared memory segment, or a new one
+
+        :param str name: name of the segment, a new segment of
+                         ``size`` bytes is created if None
+        """
+        from multiprocessing import shared_memory
+        try:
+            return shared_memory.SharedMemory(name, create=name is None, size=size,
+                                              track=False)
+        except TypeError:
+            # before Python 3.13, segments are always registered
+            shm = shared_memory.SharedMemory(name, create=name is None, size=size)
+            if os.name == 'posix':
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(shm._name, 'shared_memory')
+            return shm
+
+    @classmethod
+    def create(cls, body):
+        """copy the body in a new shared memory segment
+
+        :return: a :class:`SharedBody`, or the body if shared memory
+                 is not available
+        """
+        try:
+            from multiprocessing import shared_memory  # noqa: F401
+        except ImportError:  # pragma: nocover
+            return body
+        shm = cls.open(size=len(body))
+        shared = cls(shm.name, len(body))
+        try:
+            shm.buf[:len(body)] = body
+        except BaseException:
+            shm.close()
+            shared.unlink()
+            raise
+        # the segment remains until unlinked, mapped or not
+        shm.close()
+        return shared
+
+    def read(self):
+        """copy the body out of the segment
+
+        :return bytes: the body
+        """
+        shm = self.open(self.name)
+        try:
+            return bytes(shm.buf[:self.size])
+        finally:
+            shm.close()
+
+    def unlink(self):
+        """free the segment, if not already done"""
+        from multiprocessing import shared_memory
+        try:
+            # registered, as unlink() unregisters it before Python 3.13
+            shm = shared_memory.SharedMemory(self.name)
+        except FileNotFoundError:
+            return
+        shm.close()
+        shm.unlink()
+
+    def __len__(self):
+        return self.size
+
+
+def free_body(body):
+    """free a body handed to a pool worker, once it is done with it
+
+    :param body: either bytes or a :class:`SharedBody`
+    """
+    if isinstance(body, SharedBody):
+        body.unlink()
+
+
+def read_body(body):
+    """the bytes of a body received by a pool worker
+
+    :param body: either bytes or a :class:`SharedBody`
+    """
+    if isinstance(body, SharedBody):
+        return body.read()
+    return body
+
+
+def init_worker(lock, conf_path=None, db_path=None, run=None):
+    """setup a pool worker process
+
+    this sets up a global lock across pool processes. this is
+    necessary because Lock objects are not serializable so we can't
+    pass them as arguments. An alternative pattern is to have a
+    `Manager` process and use IPC for locking.
+
+    the number of the current run is shared the same way, as a
+    :func:`multiprocessing.RawValue`, so that workers know when to
+    sync their seen filters, see
+    :func:`feed2exec.model.FeedItemCacheStorage.start_run`.
+
+    cargo-culted from this `stackoverflow answer
+    <https://stackoverflow.com/a/25558333/1174784>`_
+
+    if ``db_path`` is provided, this also creates a
+    :class:`FeedManager` private to the worker, with its own
+    database connections and HTTP session, so that feeds can be
+    dispatched in the worker with :func:`parse_and_dispatch`. database
+    connections inherited from the parent are not reused, see
+    :func:`feed2exec.model.SqliteStorage.reset`.
+    """
+    global LOCK, RUN, WORKER_MANAGER
+    LOCK = lock
+    RUN = run
+    if db_path is not None:
+        WORKER_MANAGER = FeedManager(conf_path, db_path)
+
+
+def parse_and_dispatch(feed, body, force=False):
+    """parse and dispatch a feed in a pool worker
+
+    this runs :func:`feed2exec.model.Feed.parse` and
+    :func:`FeedManager.dispatch` in a worker setup by
+    :func:`init_worker`, so that plugins (e.g. email formatting and
+    writing to disk) also run in parallel. the global ``LOCK`` is
+    passed to plugins and used around cache updates.
+
+    this returns only the ``state_updates`` of the feed, to be saved
+    by the parent process, so that the parsed feed is not sent back.
+    """
+    if RUN is not None:
+        FeedItemCacheStorage.start_run(RUN.value)
+    data = feed.parse(read_body(body), lazy=True)
+    if data:
+        WORKER_MANAGER.dispatch(feed, data, LOCK, force)
+    return feed.state_updates
+
+
+def parse_new(feed, body, db_path, force=False):
+    """parse a feed in a pool worker, keeping only new items
+
+    this runs :func:`feed2exec.model.Feed.parse` and drops the items
+    already in the cache, as :func:`FeedManager.dispatch` would, so
+    that they are not sent back to the parent process. this is skipped
+    if the feed has a filter plugin, as it may change the GUID of
+    items, or if the ``force`` parameter is set.
+
+    :param str db_path: the path to the cache database
+    """
+    if RUN is not None:
+        FeedItemCacheStorage.start_run(RUN.value)
+    data = feed.parse(read_body(body), lazy=True)
+    if not data:
+        return data
+    if feed.get('filter') or force:
+        data['entries'] = list(data['entries'])
+    else:
+        cache = FeedItemCacheStorage(db_path, feed=feed['name'])
+        data['entries'] = list(unseen(feed, normalized(feed, data['entries']), cache, set()))
+    return data
+
+
+def normalized(feed, entries):
+    """normalize the entries with :func:`feed2exec.model.Feed.normalize`
+
+    :return: a generator of the normalized items
+    """
+    for item in entries:
+        feed.normalize(item=item)
+        yield item
+
+
+def unseen(feed, items, cache, seen, force=False):
+    """the items not already in the cache, in order
+
+    items are looked up in the cache in batches. this stops after the
+    ``seen_limit`` of the feed (:data:`DEFAULT_SEEN_LIMIT` by default,
+    zero to disable) consecutive items were already seen, so that the
+    remaining items are not even parsed with ``Feed.parse(lazy=True)``.
+
+    all the items are looked up if the ``check_all`` hint of the feed
+    is set by :func:`FeedManager.fetch_one`, in which case it is
+    recorded as the ``last_checked`` time of the feed once they all
+    were, for :func:`FeedManager.gc`.
+
+    :param items: normalized items, as an iterable
+
+    :param cache: the :class:`feed2exec.model.FeedItemCacheStorage` of
+                  the feed
+
+    :param set seen: GUIDs already seen, updated with the ones found
+                     in the cache. GUIDs added to it while iterating
+                     (e.g. when items are delivered) are also
+                     considered seen.
+
+    :param bool force: consider all items as new
+
+    :return: a generator of the new items
+    """
+    checked = feed.hints.get('check_all')
+    seen_limit = 0 if checked else feed.getnumber('seen_limit', DEFAULT_SEEN_LIMIT, int)
+    items = iter(items)
+    known = 0
+    while True:
+        batch = list(itertools.islice(items, seen_limit or CACHE_BATCH_SIZE))
+        if not batch:
+            if checked and not force:
+                # all the items in the feed were marked as seen
+                feed.state_updates['last_checked'] = checked
+            return
+        if not force:
+            # lookup all GUIDs at once instead of once per item
+            seen.update(cache.seen(item['id'] for item in batch))
+        for item in batch:
+            guid = item['id']
+            if guid not in seen:
+                known = 0
+                yield item
+                continue
+            logging.debug('item %s already seen', guid)
+            known += 1
+            if seen_limit and known >= seen_limit:
+                logging.debug('%d items already seen in feed %s, skipping the others',
+                              known, feed['name'])
+                return
+
+
+def download(response, deadline):
+    """read the body of a streamed response, within the deadline
+
+    the read timeout of :mod:`requests` applies to each read from the
+    server, so a server trickling data could otherwise keep us
+    reading, or block a thread, forever. instead, the socket is shut
+    down from another thread at the deadline, which unblocks any
+    pending read, see :func:`shutdown_response`.
+
+    :param response: a :class:`requests.Response`, with ``stream`` set
+
+    :param float deadline: the :func:`time.monotonic` time at which to
+                           abort the download
+
+    :return bytes: the body
+
+    :raises requests.exceptions.ReadTimeout: if the deadline is reached
+    """
+    import requests
+    expired = threading.Event()
+
+    def abort():
+        expired.set()
+        shutdown_response(response)
+
+    timer = threading.Timer(max(deadline - time.monotonic(), 0), abort)
+    timer.daemon = True
+    timer.start()
+    chunks = []
+    try:
+        for chunk in response.iter_content(FETCH_CHUNK_SIZE):
+            if expired.is_set():
+                break
+            chunks.append(chunk)
+    except Exception:
+        # errors caused by the shutdown are reported as a timeout below
+        if not expired.is_set():
+            raise
+    finally:
+        timer.cancel()
+    if expired.is_set():
+        raise requests.exceptions.ReadTimeout('download took too long')
+    return b''.join(chunks)
+
+
+def shutdown_response(response):
+    """unblock a thread reading the body of a streamed response
+
+    this shuts down the socket of the response, if any, so that
+    pending and future reads return immediately.
+    """
+    raw = response.raw
+    try:
+        if hasattr(raw, 'shutdown'):
+            # urllib3 2.3 and later
+            raw.shutdown()
+        else:
+            raw.connection.sock.shutdown(socket.SHUT_RDWR)
+    except (AttributeError, OSError, RuntimeError, ValueError) as e:
+        logging.debug('cannot shutdown response from %s: %s', response.url, e)
+
+
+def permanent_redirect(response):
+    """the URL reached by following only permanent redirects
+
+    :param response: a :class:`requests.Response`, whose ``history``
+                     has the redirects followed to get it
+
+    :return str: the URL, or None if the first response was not a
+                 permanent redirect
+    """
+    url = None
+    for redirect, following in zip(response.history, response.history[1:] + [response]):
+        if redirect.status_code not in PERMANENT_REDIRECTS:
+            break
+        url = following.url
+    return url
+
+
+def feed_host(feed):
+    """the host name of the feed URL, in lowercase
+
+    >>> feed_host({'url': 'https://GitHub.com/anarcat/feed2exec/releases.atom'})
+    'github.com'
+    >>> feed_host({'url': 'file:///tmp/feed.xml'})
+    ''
+    """
+    return urllib.parse.urlsplit(feed['url']).netloc.lower()
+
+
+def header_hints(headers):
+    """extract scheduling hints from HTTP response headers
+
+    the ``Expires`` header is only used without a ``Cache-Control:
+    max-age``, and is relative to the ``Date`` of the response, if
+    any, as per RFC 7234.
+
+    >>> sorted(header_hints({'Cache-Control': 'public, max-age=3600',
+    ...                      'Retry-After': '120'}).items())
+    [('max_age', 3600), ('retry_after', 120)]
+    >>> header_hints({'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})['retry_after'] <= 0
+    True
+    >>> header_hints({'Date': 'Wed, 21 Oct 2015 07:28:00 GMT',
+    ...               'Expires': 'Wed, 21 Oct 2015 08:28:00 GMT'})
+    {'max_age': 3600.0}
+    >>> header_hints({'Cache-Control': 'no-cache', 'Retry-After': 'garbage', 'Expires': '0'})
+    {}
+
+    :return dict: ``max_age`` and ``retry_after`` delays, in seconds
+    """
+    hints = {}
+    match = re.search(r'max-age=(\d+)', headers.get('Cache-Control', ''))
+    if match:
+        hints['max_age'] = int(match.group(1))
+    elif headers.get('Expires'):
+        try:
+            expires = email.utils.parsedate_to_datetime(headers['Expires']).timestamp()
+            date = time.time()
+            if headers.get('Date'):
+                date = email.utils.parsedate_to_datetime(headers['Date']).timestamp()
+        except (TypeError, ValueError):
+            logging.debug('invalid Expires or Date header: %s, %s',
+                          headers.get('Expires'), headers.get('Date'))
+        else:
+            if expires > date:
+                hints['max_age'] = expires - date
+    retry_after = headers.get('Retry-After')
+    if retry_after:
+        if retry_after.strip().isdigit():
+            hints['retry_after'] = int(retry_after)
+        else:
+            try:
+                date = email.utils.parsedate_to_datetime(retry_after)
+                hints['retry_after'] = date.timestamp() - time.time()
+            except (TypeError, ValueError):
+                logging.debug('invalid Retry-After header: %s', retry_after)
+    return hints
+
+
+def feed_hints(data):
+    """extract scheduling hints from a parsed feed
+
+    this looks at the RSS ``<ttl>`` element and the ``updatePeriod``
+    and ``updateFrequency`` elements from the syndication module.
+
+    >>> feed_hints({'feed': {'ttl': '60'}})
+    {'ttl': 3600}
+    >>> feed_hints({'feed': {'sy_updateperiod': 'daily', 'sy_updatefrequency': '2'}})
+    {'ttl': 43200.0}
+    >>> feed_hints({'feed': {'ttl': 'soon', 'sy_updatefrequency': '0'}})
+    {}
+
+    :return dict: a ``ttl`` delay, in seconds
+    """
+    meta = data.get('feed', {})
+    hints = {}
+    try:
+        hints['ttl'] = int(meta['ttl']) * 60
+    except (KeyError, TypeError, ValueError):
+        pass
+    if 'sy_updateperiod' in meta or 'sy_updatefrequency' in meta:
+        # the period defaults to daily, as per the specification
+        period = UPDATE_PERIODS.get(str(meta.get('sy_updateperiod', 'daily')).strip().lower())
+        try:
+            frequency = int(meta.get('sy_updatefrequency', 1))
+            hints['ttl'] = max(hints.get('ttl', 0), period / frequency)
+        except (TypeError, ValueError, ZeroDivisionError):
+            pass
+    return hints
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+'''date parsing helpers for feedparser'''
+
+from __future__ import absolute_import
+
+import calendar
+import datetime
+import email.utils
+import functools
+import time
+
+#: number of distinct date strings whose parsed value is remembered,
+#: see :func:`parse_date`
+DATE_CACHE_SIZE = 4096
+
+#: set once the date handler is registered in feedparser, see
+#: :func:`register_date_handler`
+date_handler_registered = False
+
+
+def parse_rfc822(string):
+    """parse a RFC 822 date, as found in RSS feeds
+
+    dates without a timezone are assumed to be UTC.
+
+    >>> parse_rfc822('Sun, 06 Sep 2009 12:20:00 -0400')[:6]
+    (2009, 9, 6, 16, 20, 0)
+    >>> parse_rfc822('2009-09-06T16:20:00Z') is None
+    True
+
+    :return time.struct_time: the date in UTC, or None if the string
+                              cannot be parsed
+    """
+    parsed = email.utils.parsedate_tz(string)
+    if parsed is None:
+        return None
+    return time.gmtime(calendar.timegm(parsed[:9]) - (parsed[9] or 0))
+
+
+def parse_iso8601(string):
+    """parse an ISO 8601 date, as found in Atom feeds
+
+    dates without a timezone are assumed to be UTC.
+
+    >>> parse_iso8601('2009-09-06T12:20:00-04:00')[:6]
+    (2009, 9, 6, 16, 20, 0)
+    >>> parse_iso8601('2009-09-06T16:20:00Z')[:6]
+    (2009, 9, 6, 16, 20, 0)
+    >>> parse_iso8601('Sun, 06 Sep 2009 16:20:00 +0000') is None
+    True
+
+    :return time.struct_time: the date in UTC, or None if the string
+                              cannot be parsed
+    """
+    fromisoformat = getattr(datetime.datetime, 'fromisoformat', None)
+    if fromisoformat is None:  # pragma: nocover
+        # Python 3.6
+        return None
+    if string.endswith(('Z', 'z')):
+        # only supported starting with Python 3.11
+        string = string[:-1] + '+00:00'
+    try:
+        return fromisoformat(string).utctimetuple()
+    except ValueError:
+        return None
+
+
+def parse_dateparser(string):
+    """parse any date with :mod:`dateparser`, if available
+
+    this is slow, both to import and to run, so it is only used as a
+    last resort by :func:`parse_date`.
+
+    :return time.struct_time: the date in UTC, or None if the string
+                              cannot be parsed
+    """
+    try:
+        import dateparser
+    except ImportError:
+        return None
+    from pkg_resources import parse_version
+    if parse_version(dateparser.__version__) < parse_version('0.7.4'):
+        # workaround bug https://github.com/scrapinghub/dateparser/issues/548
+        if string.endswith('-0000'):
+            # replace the last '-0000' with '+0000' by reversing the string twice
+            string = string[::-1].replace('-0000'[::-1], '+0000'[::-1], 1)[::-1]
+    date = dateparser.parse(string)
+    if date is None:
+        return None
+    return date.utctimetuple()
+
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_date(string):
+    """parse a date string into a UTC time tuple
+
+    the common RFC 822 and ISO 8601 formats are handled directly, and
+    :mod:`dateparser` is used only for the other strings. results are
+    cached, as feeds often repeat the same dates (e.g. in the
+    ``updated`` and ``published`` fields, or between runs of the
+    daemon).
+
+    >>> parse_date('Tue,19 Feb 2019 14:08:19 GMT')[:6]
+    (2019, 2, 19, 14, 8, 19)
+    >>> parse_date('2017-08-30T10:12:07+00:00')[:6]
+    (2017, 8, 30, 10, 12, 7)
+
+    :return time.struct_time: the date in UTC, or None if the string
+                              cannot be parsed
+    """
+    for parser in (parse_rfc822, parse_iso8601, parse_dateparser):
+        try:
+            date = parser(string)
+        except (OverflowError, ValueError, TypeError):
+            date = None
+        if date is not None:
+            return date
+    return None
+
+
+def register_date_handler():
+    """teach feedparser to parse more dates with :func:`parse_date`
+
+    this is done before the first feed is parsed instead of on
+    startup, as dateparser is very slow to import and most commands
+    do not parse anything.
+    """
+    global date_handler_registered
+    if date_handler_registered:
+        return
+    date_handler_registered = True
+    import feedparser
+    feedparser.registerDateHandler(parse_date)
@@ -0,0 +1,354 @@
+# coding: utf-8
+
+'''fast parser for well-formed RSS 2.0 and Atom 1.0 feeds
+
+this parses feeds with :func:`lxml.etree.iterparse` instead of
+:mod:`feedparser`, which is much slower as it supports every feed
+format ever published and goes through great lengths to make sense of
+broken feeds.
+
+only the fields used by feed2exec and its plugins are extracted, in
+the same structure as feedparser, so that the result can be used
+interchangeably. for example, enclosures are stored in the ``links``
+of entries, from which :class:`feedparser.FeedParserDict` computes
+their ``enclosures``. a :class:`UnsupportedFeed` exception is raised for
+anything else (malformed XML, other formats, markup inside elements,
+etc), in which case the caller should use feedparser instead.
+
+like ``trusted`` feeds, HTML content is neither sanitized nor are
+relative links in it resolved.
+'''
+
+from __future__ import division, absolute_import
+from __future__ import print_function
+
+import email.message
+import email.utils
+import io
+import itertools
+
+from feedparser import FeedParserDict
+
+from feed2exec.dates import parse_date
+
+ATOM = '{http://www.w3.org/2005/Atom}'
+CONTENT = '{http://purl.org/rss/1.0/modules/content/}'
+DC = '{http://purl.org/dc/elements/1.1/}'
+SY = '{http://purl.org/rss/1.0/modules/syndication/}'
+XML = '{http://www.w3.org/XML/1998/namespace}'
+XHTML = '{http://www.w3.org/1999/xhtml}'
+
+#: RSS channel elements and the key they are stored in
+RSS_FEED_FIELDS = {
+    'title': 'title',
+    'link': 'link',
+    'description': 'subtitle',
+    'language': 'language',
+    'pubDate': 'published',
+    'lastBuildDate': 'updated',
+    DC + 'date': 'updated',
+    'ttl': 'ttl',
+    SY + 'updatePeriod': 'sy_updateperiod',
+    SY + 'updateFrequency': 'sy_updatefrequency',
+}
+
+#: RSS item elements and the key they are stored in
+RSS_ITEM_FIELDS = {
+    'title': 'title',
+    'link': 'link',
+    'description': 'summary',
+    'pubDate': 'published',
+    DC + 'date': 'updated',
+}
+
+#: Atom feed and entry elements holding plain text, and the key they
+#: are stored in
+ATOM_FIELDS = {
+    ATOM + 'id': 'id',
+    ATOM + 'published': 'published',
+    ATOM + 'updated': 'updated',
+    SY + 'updatePeriod': 'sy_updateperiod',
+    SY + 'updateFrequency': 'sy_updatefrequency',
+}
+
+#: Atom text constructs and the key they are stored in
+ATOM_TEXT_FIELDS = {
+    ATOM + 'title': 'title',
+    ATOM + 'subtitle': 'subtitle',
+    ATOM + 'summary': 'summary',
+}
+
+#: MIME types of the Atom text construct types
+ATOM_TYPES = {'text': 'text/plain', 'html': 'text/html'}
+
+
+class UnsupportedFeed(Exception):
+    """the feed cannot be parsed here, use feedparser instead"""
+    pass
+
+
+def text(elem):
+    """the stripped text of an element, which should not have children"""
+    if len(elem):
+        raise UnsupportedFeed('markup found in <%s>' % elem.tag)
+    return (elem.text or '').strip()
+
+
+def atom_text(elem):
+    """the MIME type and text of an Atom text construct"""
+    mimetype = ATOM_TYPES.get(elem.get('type', 'text'))
+    if mimetype is None or elem.get('src'):
+        raise UnsupportedFeed('unsupported <%s> type %s' % (elem.tag, elem.get('type')))
+    return mimetype, text(elem)
+
+
+def language(elem):
+    """the language of the element, from the closest ``xml:lang``"""
+    while elem is not None:
+        if elem.get(XML + 'lang'):
+            return elem.get(XML + 'lang')
+        elem = elem.getparent()
+    return None
+
+
+def author_detail(value):
+    """parse a RSS author, which has an email and an optional name
+
+    >>> author_detail('from@example.com (test author)') == {'name': 'test author', 'email': 'from@example.com'}
+    True
+    >>> author_detail('test author')
+    {'name': 'test author'}
+    """
+    if '@' not in value:
+        return FeedParserDict(name=value)
+    name, address = email.utils.parseaddr(value)
+    detail = FeedParserDict(email=address)
+    if name:
+        detail['name'] = name
+    return detail
+
+
+def add_dates(data):
+    """parse the ``published`` and ``updated`` dates, if any"""
+    for key in ('published', 'updated'):
+        if key in data:
+            data[key + '_parsed'] = parse_date(data[key])
+
+
+def rss_fields(elem, fields, data):
+    """store the ``fields`` found in the children of ``elem`` in ``data``
+
+    the first occurence of a field wins, and children already stored
+    elsewhere (e.g. ``<item>`` elements) are skipped.
+    """
+    for child in elem:
+        key = fields.get(child.tag)
+        if key is not None and key not in data:
+            data[key] = text(child)
+        elif child.tag in ('author', 'managingEditor', DC + 'creator') and 'author' not in data:
+            data['author'] = text(child)
+            data['author_detail'] = author_detail(data['author'])
+    add_dates(data)
+    return data
+
+
+def rss_item(elem):
+    """extract an entry from an RSS ``<item>``"""
+    entry = rss_fields(elem, RSS_ITEM_FIELDS, FeedParserDict())
+    for child in elem:
+        if child.tag == 'guid' and 'id' not in entry:
+            entry['id'] = text(child)
+            if 'link' not in entry and child.get('isPermaLink', 'true') != 'false':
+                # checked again below, as <link> may come after
+                entry['guidlink'] = entry['id']
+        elif child.tag in (CONTENT + 'encoded', 'body', XHTML + 'body'):
+            mimetype = 'text/html' if child.tag == CONTENT + 'encoded' else 'application/xhtml+xml'
+            entry.setdefault('content', []).append(
+                FeedParserDict(type=mimetype, language=language(child),
+                               base='', value=text(child)))
+        elif child.tag == 'link':
+            link = FeedParserDict(rel='alternate', type='text/html')
+            if text(child):
+                link['href'] = text(child)
+            entry.setdefault('links', []).append(link)
+        elif child.tag == 'enclosure':
+            enclosure = FeedParserDict(rel='enclosure', href=child.get('url', '').strip())
+            for key in ('length', 'type'):
+                if child.get(key):
+                    enclosure[key] = child.get(key)
+            entry.setdefault('links', []).append(enclosure)
+    guidlink = entry.pop('guidlink', None)
+    if guidlink and 'link' not in entry:
+        entry['link'] = guidlink
+    return entry
+
+
+def atom_link(elem):
+    """a link from an Atom ``<link>``, with feedparser's defaults"""
+    rel = elem.get('rel', 'alternate')
+    link = FeedParserDict(rel=rel, href=elem.get('href', '').strip(),
+                          type=elem.get('type', 'application/atom+xml' if rel == 'self'
+                                        else 'text/html'))
+    for key in ('length', 'title', 'hreflang'):
+        if elem.get(key):
+            link[key] = elem.get(key)
+    return link
+
+
+def atom_fields(elem, data):
+    """store the Atom elements found in the children of ``elem`` in ``data``"""
+    links = []
+    for child in elem:
+        if child.tag in ATOM_FIELDS:
+            data.setdefault(ATOM_FIELDS[child.tag], text(child))
+        elif child.tag in ATOM_TEXT_FIELDS:
+            data.setdefault(ATOM_TEXT_FIELDS[child.tag], atom_text(child)[1])
+        elif child.tag == ATOM + 'link':
+            link = atom_link(child)
+            if link['rel'] == 'alternate':
+                data.setdefault('link', link['href'])
+            links.append(link)
+        elif child.tag == ATOM + 'author' and 'author' not in data:
+            detail = FeedParserDict()
+            for key, tag in (('name', 'name'), ('email', 'email'), ('href', 'uri')):
+                value = child.find(ATOM + tag)
+                if value is not None:
+                    detail[key] = text(value)
+            data['author_detail'] = detail
+            if 'name' in detail and 'email' in detail:
+                data['author'] = '%s (%s)' % (detail['name'], detail['email'])
+            else:
+                data['author'] = detail.get('name', detail.get('email', ''))
+        elif child.tag == ATOM + 'content':
+            mimetype, value = atom_text(child)
+            data.setdefault('content', []).append(
+                FeedParserDict(type=mimetype, language=language(child),
+                               base='', value=value))
+    if links:
+        data.setdefault('links', links)
+    if 'summary' not in data and data.get('content'):
+        data['summary'] = data['content'][0]['value']
+    add_dates(data)
+    return data
+
+
+#: tags of the entries and of their parent element, for each version
+ENTRY_TAGS = {'rss20': ('item', 'channel'),
+              'atom10': (ATOM + 'entry', ATOM + 'feed')}
+
+
+def feed_fields(parent, version, feed):
+    """store the elements of the ``parent`` of the entries in ``feed``"""
+    if version == 'rss20':
+        rss_fields(parent, RSS_FEED_FIELDS, feed)
+    else:
+        atom_fields(parent, feed)
+        if language(parent):
+            feed['language'] = language(parent)
+
+
+def iterentries(context, version, feed):
+    """parse the entries of the feed as they are iterated over
+
+    the elements of the feed found before the first entry are stored
+    in ``feed`` when that entry starts, and the others once the whole
+    document is parsed.
+
+    :param context: the :class:`lxml.etree.iterparse` of the feed,
+                    past its root element
+    """
+    from lxml import etree
+
+    entry_tag, parent_tag = ENTRY_TAGS[version]
+    started = False
+    try:
+        for event, elem in context:
+            if elem.tag != entry_tag or elem.getparent().tag != parent_tag:
+                continue
+            if event == 'start':
+                if not started:
+                    feed_fields(elem.getparent(), version, feed)
+                    started = True
+                continue
+            if version == 'rss20':
+                entry = rss_item(elem)
+            else:
+                entry = atom_fields(elem, FeedParserDict())
+            # the entry is parsed, free up memory
+            elem.clear()
+            yield entry
+    except (etree.XMLSyntaxError, LookupError, UnicodeError) as e:
+        raise UnsupportedFeed('malformed feed: %s' % e)
+    parent = context.root
+    if version == 'rss20':
+        parent = parent.find('channel')
+        if parent is None:
+            raise UnsupportedFeed('no channel in RSS feed')
+    feed_fields(parent, version, feed)
+
+
+def parse(body, headers=None, lazy=False):
+    """parse the given feed body
+
+    the charset declared in the ``Content-Type`` of the ``headers``, if
+    any, has priority over the one declared in the document, as in
+    feedparser.
+
+    >>> data = parse(b'<rss version="2.0"><channel><title>t</title><item><guid>1</guid></item></channel></rss>')
+    >>> data['feed']['title'], data['entries'][0]['id']
+    ('t', '1')
+    >>> parse(b'<rss version="0.91"/>')
+    Traceback (most recent call last):
+    ...
+    feed2exec.fastparse.UnsupportedFeed: unsupported format: rss 0.91
+
+    :param bytes body: the body of the feed
+
+    :param dict headers: the HTTP headers of the response, with
+                         lowercase keys
+
+    :param bool lazy: only parse the feed up to its first entry, the
+                      ``entries`` being a generator parsing the others
+                      when needed. the :class:`UnsupportedFeed`
+                      exception may then also be raised while
+                      iterating over them.
+
+    :return dict: the parsed data, with the ``feed`` and ``entries``
+                  keys, like :func:`feedparser.parse`
+
+    :raises UnsupportedFeed: if the feed should be parsed by
+                             feedparser instead
+    """
+    from lxml import etree
+
+    encoding = None
+    if headers and headers.get('content-type'):
+        msg = email.message.Message()
+        msg['content-type'] = headers['content-type']
+        encoding = msg.get_content_charset()
+    context = etree.iterparse(io.BytesIO(body), events=('start', 'end'),
+                              encoding=encoding, resolve_entities=False,
+                              no_network=True)
+    try:
+        # the first event is the start of the root element
+        _, root = next(context)
+    except (etree.XMLSyntaxError, LookupError, UnicodeError, StopIteration) as e:
+        raise UnsupportedFeed('malformed feed: %s' % e)
+    if root.tag == 'rss' and root.get('version') == '2.0':
+        version = 'rss20'
+    elif root.tag == ATOM + 'feed':
+        version = 'atom10'
+    else:
+        raise UnsupportedFeed('unsupported format: %s %s'
+                              % (etree.QName(root).localname, root.get('version', '')))
+    feed = FeedParserDict()
+    entries = iterentries(context, version, feed)
+    if lazy:
+        # parse up to the first entry, and the feed elements before it
+        first = list(itertools.islice(entries, 1))
+        entries = itertools.chain(first, entries)
+    else:
+        entries = list(entries)
+    return FeedParserDict(feed=feed, entries=entries, bozo=False,
+                          version=version,
+                          encoding=root.getroottree().docinfo.encoding)
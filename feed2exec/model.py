@@ -20,7 +20,7 @@
 from __future__ import division, absolute_import
 from __future__ import print_function
 
-from typing import Optional, Dict
+from typing import Dict, List, Optional, Set, Union
 
 try:
     import configparser
@@ -30,9 +30,15 @@ except ImportError:  # pragma: nocover
 from collections import OrderedDict, namedtuple
 from contextlib import contextmanager
 from datetime import datetime
+import hashlib
 import logging
+import math
+import os
 import os.path
-from threading import Lock
+import re
+import struct
+from threading import RLock
+import time
 try:
     import urllib.parse as urlparse
 except ImportError:  # pragma: nocover
@@ -41,6 +47,8 @@ except ImportError:  # pragma: nocover
 import warnings
 
 import feed2exec
+import feed2exec.dates as dates
+import feed2exec.fastparse as fastparse
 import feed2exec.utils as utils
 
 import feedparser
@@ -48,6 +56,13 @@ import sqlite3
 import xdg.BaseDirectory as xdg_base_dirs
 
 
+#: what we know of the HTTP response a feed was fetched from: the
+#: final ``url``, after redirects, the ``status`` code, the
+#: ``headers``, in a dict with lowercase keys, and the ``encoding``
+#: they declare, if any
+FeedResponse = namedtuple('FeedResponse', 'url status headers encoding')
+
+
 class Feed(feedparser.FeedParserDict):
     """basic data structure representing a RSS or Atom feed.
 
@@ -61,11 +76,31 @@ class Feed(feedparser.FeedParserDict):
     unless otherwise noted.
     """
     locked_keys = ('output', 'args', 'filter', 'filter_args',
-                   'folder', 'mailbox', 'url', 'name', 'pause', 'catchup')
+                   'folder', 'mailbox', 'url', 'name', 'pause', 'catchup',
+                   'min_interval', 'max_interval',
+                   'connect_timeout', 'read_timeout', 'feed_timeout', 'trusted',
+                   'parser', 'seen_limit')
 
     def __init__(self, name, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self['name'] = name
+        #: changes to the :class:`FeedStateStorage` for this feed,
+        #: saved only once the feed is processed
+        self.state_updates = {}
+        #: scheduling hints found while fetching the feed, see
+        #: :func:`feed2exec.controller.FeedManager.schedule`
+        self.hints = {}
+        #: the :class:`FeedResponse` the feed was fetched from, if any
+        self.response = None
+
+    def __reduce__(self):
+        """make sure feeds are unpickled as is
+
+        the default pickling would restore items through the upstream
+        setter, which renames some keys (e.g. ``url`` to ``href``)
+        when feeds are passed to worker processes.
+        """
+        return (self.__class__, (self['name'], dict(self)), self.__dict__)
 
     def get(self, key, default=None):
         """override upstream getter
@@ -84,6 +119,61 @@ class Feed(feedparser.FeedParserDict):
         else:
             return v
 
+    def getboolean(self, key, default=False):
+        """the value of a boolean setting
+
+        this accepts the same values as
+        :func:`configparser.ConfigParser.getboolean`. other values are
+        considered false, with a warning.
+
+        >>> Feed('test', {'trusted': 'no'}).getboolean('trusted')
+        False
+        >>> Feed('test', {'trusted': 'Yes'}).getboolean('trusted')
+        True
+        """
+        value = self.get(key)
+        if value is None:
+            return default
+        if isinstance(value, bool):
+            return value
+        try:
+            return configparser.ConfigParser.BOOLEAN_STATES[str(value).strip().lower()]
+        except KeyError:
+            logging.warning('invalid value for %s in feed %s, assuming false: %s',
+                            key, self['name'], value)
+            return False
+
+    def getnumber(self, key, default, cast=float, positive=False):
+        """the value of a numeric setting
+
+        negative values, or zero if ``positive`` is set, are invalid
+        as well. the ``default`` is used instead of invalid values,
+        with a warning, so that a typo in a single feed does not
+        abort a whole run.
+
+        :param cast: the type of the value, :class:`float` or
+                     :class:`int`
+
+        >>> Feed('test', {'seen_limit': '5'}).getnumber('seen_limit', 10, int)
+        5
+        >>> Feed('test', {'seen_limit': 'abc'}).getnumber('seen_limit', 10, int)
+        10
+        >>> Feed('test', {'feed_timeout': '0'}).getnumber('feed_timeout', 60.0, positive=True)
+        60.0
+        """
+        value = self.get(key)
+        if value is None:
+            return default
+        try:
+            number = cast(value)
+        except (TypeError, ValueError):
+            number = None
+        if number is None or not math.isfinite(number) or number < 0 or (positive and not number):
+            logging.warning('invalid value for %s in feed %s, using %s: %s',
+                            key, self['name'], default, value)
+            return default
+        return number
+
     def normalize(self, item=None):
         """normalize feeds a little more than what feedparser provides.
 
@@ -131,15 +221,26 @@ class Feed(feedparser.FeedParserDict):
         # 3. not completely absolute links
         scheme, netloc, *rest = urlparse.urlsplit(item.get('link', ''))
         if not scheme:
-            # take missing scheme/host from feed URL
-            scheme, netloc, *_ = urlparse.urlsplit(self.get('url', ''))
+            # take missing scheme/host from the URL the feed was
+            # actually fetched from, or the configured one
+            base = self.response.url if self.response else self.get('url', '')
+            scheme, netloc, *_ = urlparse.urlsplit(base)
             item['link'] = urlparse.urlunsplit((scheme, netloc, *rest))
 
-    def parse(self, body):
+    def parse(self, body, lazy=False):
         """parse the body of the feed
 
         this parses the given body using :mod:`feedparser` and returns
-        the parsed data.
+        the parsed data. the headers of the :attr:`response`, if any,
+        are passed along so that the declared charset is used.
+
+        if the feed is ``trusted``, HTML content is not sanitized and
+        relative links in it are not resolved, which is much faster.
+
+        if the ``parser`` setting is ``lxml``, the much faster
+        :func:`feed2exec.fastparse.parse` is tried first, which
+        implies the above. feedparser is still used if that fails,
+        e.g. for malformed feeds.
 
         :todo: this could be moved to a plugin, but then we'd need to take
                out the cache checking logic, which would remove most of
@@ -149,15 +250,45 @@ class Feed(feedparser.FeedParserDict):
 
         :param dict self: a feed object used to pass to plugins and debugging
 
+        :param bool lazy: with the ``lxml`` parser, parse entries only
+                          as they are iterated over, so that
+                          :func:`feed2exec.controller.FeedManager.dispatch`
+                          can stop early. the ``entries`` are then a
+                          generator, which cannot be pickled.
+
         :return dict: the parsed data
 
         """
         logging.info('parsing feed %s (%d bytes)', self['url'], len(body))
-        try:
-            data = feedparser.parse(body)
-        except Exception as e:
-            logging.warning('feedparser failed: either a bug or a malformed feed: %s (feed skipped)', e)
-            return None
+        dates.register_date_handler()
+        kwargs = {}
+        if self.response is not None:
+            # for the declared charset. feedparser would also resolve
+            # relative GUIDs against a base URL, which would change
+            # them, see normalize() for links instead
+            headers = dict(self.response.headers)
+            headers.pop('content-location', None)
+            kwargs['response_headers'] = headers
+        if self.getboolean('trusted'):
+            # those are among the slowest steps of feedparser, and
+            # only needed if the content may end up in a browser
+            kwargs.update(sanitize_html=False, resolve_relative_uris=False)
+        data = None
+        if self.get('parser', 'feedparser') == 'lxml':
+            try:
+                data = fastparse.parse(body, headers=kwargs.get('response_headers'), lazy=lazy)
+            except fastparse.UnsupportedFeed as e:
+                logging.info('feed %s cannot be parsed with lxml, using feedparser: %s',
+                             self['name'], e)
+            else:
+                if lazy:
+                    data['entries'] = self._fallback_entries(data['entries'], body, kwargs)
+        if data is None:
+            try:
+                data = feedparser.parse(body, **kwargs)
+            except Exception as e:
+                logging.warning('feedparser failed: either a bug or a malformed feed: %s (feed skipped)', e)
+                return None
         # add metadata from the feed without overriding user config
         for (key, val) in data['feed'].items():
             if key not in self and key not in Feed.locked_keys:
@@ -171,6 +302,28 @@ class Feed(feedparser.FeedParserDict):
             data['bozo_exception'] = str(data['bozo_exception'])
         return data
 
+    def _fallback_entries(self, entries, body, kwargs):
+        """iterate over lazily parsed entries, with feedparser for the rest
+
+        this is for errors found by :func:`feed2exec.fastparse.parse`
+        only after some entries were parsed: feedparser then parses
+        the whole feed, and the entries not already returned are used.
+        """
+        count = 0
+        try:
+            for entry in entries:
+                count += 1
+                yield entry
+        except fastparse.UnsupportedFeed as e:
+            logging.info('feed %s cannot be parsed with lxml after %d entries, using feedparser: %s',
+                         self['name'], count, e)
+            try:
+                data = feedparser.parse(body, **kwargs)
+            except Exception as e:
+                logging.warning('feedparser failed: either a bug or a malformed feed: %s (feed skipped)', e)
+                return
+            yield from data['entries'][count:]
+
 
 class FeedConfStorage(configparser.RawConfigParser):
     """Feed configuration stored in a config file.
@@ -240,6 +393,17 @@ class FeedConfStorage(configparser.RawConfigParser):
         super(FeedConfStorage, self).set(section, option, value)
         self.commit()
 
+    def set_many(self, changes):
+        """set multiple options, writing the changes only once
+
+        :param list changes: ``(section, option, value)`` tuples
+
+        not thread-safe
+        """
+        for section, option, value in changes:
+            super(FeedConfStorage, self).set(section, option, value)
+        self.commit()
+
     def remove_option(self, section, option):
         """override parent to make sure we immediately write changes
 
@@ -274,10 +438,84 @@ class FeedConfStorage(configparser.RawConfigParser):
 
 
 class SqliteStorage(object):
-    sql: Optional[str] = None
+    """base class for the SQLite storage
+
+    all storage classes share the same database file, whose schema is
+    defined by the :attr:`migrations` below. the schema version is
+    stored in the ``user_version`` pragma and missing migrations are
+    applied when the database is first opened.
+    """
+    #: list of schema migrations, each a list of SQL statements. the
+    #: database ``user_version`` is the number of migrations
+    #: applied. never modify existing migrations, add new ones at
+    #: the end of the list.
+    migrations: List[List[str]] = [
+        # 1. original schema, tables may already exist in databases
+        # created before versioning
+        ['''CREATE TABLE IF NOT EXISTS
+            feedcache (name text, guid text,
+            PRIMARY KEY (name, guid))''',
+         '''CREATE TABLE IF NOT EXISTS
+            content (key, value,
+            PRIMARY KEY (key))'''],
+        # 2. lookups by GUID across all feeds
+        ['CREATE INDEX IF NOT EXISTS feedcache_guid ON feedcache (guid)'],
+        # 3. per-feed state, see FeedStateStorage
+        ['''CREATE TABLE feedstate (name text PRIMARY KEY,
+                                     etag text, last_modified text)'''],
+        # 4. digest of the last body
+        ['ALTER TABLE feedstate ADD COLUMN digest text'],
+        # 5. polling schedule, as timestamps and seconds
+        ['ALTER TABLE feedstate ADD COLUMN last_fetch real',
+         'ALTER TABLE feedstate ADD COLUMN last_new_item real',
+         'ALTER TABLE feedstate ADD COLUMN interval real',
+         'ALTER TABLE feedstate ADD COLUMN next_fetch real'],
+        # 6. consecutive failures, see FeedManager.record_failure
+        ['ALTER TABLE feedstate ADD COLUMN failures integer',
+         'ALTER TABLE feedstate ADD COLUMN last_error text',
+         'ALTER TABLE feedstate ADD COLUMN last_failure real',
+         'ALTER TABLE feedstate ADD COLUMN paused text'],
+        # 7. permanent redirects, see FeedManager.fetch_one
+        ['ALTER TABLE feedstate ADD COLUMN redirect_from text',
+         'ALTER TABLE feedstate ADD COLUMN redirect_url text'],
+        # 8. deletions from the feed cache, see SeenFilter
+        ['CREATE TABLE feedcache_changes (deletes integer)',
+         'INSERT INTO feedcache_changes VALUES (0)',
+         '''CREATE TRIGGER feedcache_delete AFTER DELETE ON feedcache
+            BEGIN UPDATE feedcache_changes SET deletes = deletes + 1; END'''],
+        # 9. timestamps of cache entries, see FeedItemCacheStorage.prune.
+        # entries from before are considered seen on upgrade
+        ['ALTER TABLE feedcache ADD COLUMN first_seen real',
+         'ALTER TABLE feedcache ADD COLUMN last_seen real',
+         "UPDATE feedcache SET last_seen = CAST(strftime('%s', 'now') AS real)"],
+        # 10. last time all the items of a feed were looked up, see
+        # FeedManager.gc
+        ['ALTER TABLE feedstate ADD COLUMN last_checked real'],
+    ]
+    #: pragmas set on every new connection. WAL allows readers and a
+    #: writer to work concurrently, across processes, which is
+    #: necessary for parallel jobs and overlapping runs. it should be
+    #: disabled on network filesystems, where it is not supported.
+    pragmas: Dict[str, Union[str, int]] = OrderedDict([
+        ('journal_mode', 'WAL'),
+        # safe with WAL: a power loss may only lose the last commits
+        ('synchronous', 'NORMAL'),
+        # negative values are in KiB
+        ('cache_size', -8192),
+    ])
+    #: how long to wait, in seconds, for another process to release a
+    #: lock on the database before failing with "database is locked"
+    timeout = 60.0
     record = None
+    #: connections, locks and transaction depths for the process
+    #: identified by :attr:`pid`, indexed by path
     cache: Dict[str, sqlite3.Connection] = {}
-    locks: Dict[str, Lock] = {}
+    locks: Dict[str, RLock] = {}
+    transactions: Dict[str, int] = {}
+    pid: Optional[int] = None
+    #: connections inherited from a parent process, kept around so
+    #: they are never closed (or used) in the child
+    orphans: List[sqlite3.Connection] = []
     table_name: Optional[str] = None
     key_name = 'key'
     value_name = 'value'
@@ -286,32 +524,129 @@ class SqliteStorage(object):
         self.path = os.path.expanduser(path)
         assert self.path
         utils.make_dirs_helper(os.path.dirname(self.path))
-        if self.sql:
-            with self.connection() as con:
-                con.execute(self.sql)
+        # make sure the database is created and migrated
+        with self.connection(commit=False):
+            pass
 
     @contextmanager
     def connection(self, commit=True):
-        if self.path not in SqliteStorage.locks:
-            SqliteStorage.locks[self.path] = Lock()
-        with SqliteStorage.locks[self.path]:
+        """return the connection to the database, with its lock held
+
+        the lock is reentrant, so this can be nested. changes are
+        committed when leaving the block if ``commit`` is set, unless
+        we are within a :func:`transaction`.
+        """
+        if SqliteStorage.pid != os.getpid():
+            # we were forked, connections and locks are unusable
+            SqliteStorage.reset()
+        lock = SqliteStorage.locks.setdefault(self.path, RLock())
+        with lock:
             con = self.connect_cache(self.path)
             yield con
-            if commit:
+            if commit and not SqliteStorage.transactions.get(self.path):
                 con.commit()
 
+    @contextmanager
+    def transaction(self):
+        """group all writes in the block in a single transaction
+
+        changes are committed only once, when leaving the outermost
+        block, instead of after every write, which saves a disk sync
+        per write. if an exception is raised, changes are rolled back
+        instead.
+
+        the database lock is held for the whole block, so it should
+        not include slow operations like network requests.
+        """
+        with self.connection(commit=False) as con:
+            depth = SqliteStorage.transactions.get(self.path, 0)
+            SqliteStorage.transactions[self.path] = depth + 1
+            try:
+                yield con
+            except BaseException:
+                if not depth:
+                    con.rollback()
+                raise
+            else:
+                if not depth:
+                    con.commit()
+            finally:
+                SqliteStorage.transactions[self.path] = depth
+
+    def vacuum(self):
+        """rebuild the database file to reclaim the space of deleted rows
+
+        this rewrites the whole database, so it is slow on large
+        databases and temporarily needs as much free disk space.
+        """
+        with self.connection(commit=False) as con:
+            con.commit()
+            con.execute('VACUUM')
+            # also truncate the write-ahead log
+            con.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    @classmethod
+    def reset(cls):
+        """forget about existing connections and locks
+
+        this is called automatically by :func:`connection` after a
+        fork, as SQLite connections must not be shared with a child
+        process, and locks may have been held by threads that do not
+        exist in the child.
+        """
+        if SqliteStorage.pid is not None:
+            logging.debug('new process %d, dropping connections from %d',
+                          os.getpid(), SqliteStorage.pid)
+        # closing the connections could also disturb the parent
+        SqliteStorage.orphans.extend(SqliteStorage.cache.values())
+        SqliteStorage.cache.clear()
+        SqliteStorage.locks.clear()
+        SqliteStorage.transactions.clear()
+        SqliteStorage.pid = os.getpid()
+
     @classmethod
     def connect_cache(cls, path):
         if path not in cls.cache:
             logging.info('connecting to database at %s', path)
-            conn = sqlite3.connect(path)
+            # connections are shared between the fetch threads, but
+            # access is serialized through the locks in connection()
+            conn = sqlite3.connect(path, timeout=cls.timeout,
+                                   check_same_thread=False)
             try:
                 conn.set_trace_callback(logging.debug)
             except AttributeError:  # pragma: nocover
                 logging.debug('no logging support in sqlite')
+            for pragma, value in cls.pragmas.items():
+                # pragmas do not support parameters
+                conn.execute('PRAGMA %s = %s' % (pragma, value))
+            cls.migrate(conn)
             cls.cache[path] = conn
         return cls.cache[path]
 
+    @classmethod
+    def migrate(cls, conn):
+        """bring the database schema up to date
+
+        this applies the :attr:`migrations` missing from the database,
+        based on its ``user_version``, each in its own transaction.
+        the version is read again once the write lock is taken, as
+        other processes may be migrating the same database.
+        """
+        while conn.execute('PRAGMA user_version').fetchone()[0] < len(cls.migrations):
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                version = conn.execute('PRAGMA user_version').fetchone()[0]
+                if version < len(cls.migrations):
+                    logging.info('migrating database schema to version %d', version + 1)
+                    for sql in cls.migrations[version]:
+                        conn.execute(sql)
+                    # pragmas do not support parameters
+                    conn.execute('PRAGMA user_version = %d' % (version + 1))
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+            conn.commit()
+
     @classmethod
     def guess_path(cls):
         cache_home_db = os.path.join(xdg_base_dirs.xdg_cache_home, 'feed2exec.db')
@@ -365,59 +700,413 @@ class SqliteStorage(object):
             return cur.execute("SELECT * from `%s`" % self.table_name)
 
 
+class SeenFilter(object):
+    """Bloom filter of the ``(feed, guid)`` pairs in the feed cache
+
+    this answers whether a GUID is *definitely not* in the cache,
+    without any query, so that :func:`FeedItemCacheStorage.seen` only
+    looks up possible hits in the database.
+
+    the filter is saved next to the database, with the ``rowid`` of
+    the last cache entry it has. entries added since, possibly by
+    other processes, are added when the filter is first used in a
+    run, see :func:`FeedItemCacheStorage.start_run`. entries
+    cannot be removed from a Bloom filter, and their ``rowid`` may be
+    reused, so it is rebuilt when the number of deletions (maintained
+    by a trigger in the ``feedcache_changes`` table) changes.
+    """
+    #: false positive rate the filter is sized for
+    error_rate = 0.01
+    #: minimum number of entries the filter is sized for
+    min_capacity = 100000
+    #: magic number, number of hashes, capacity, number of entries,
+    #: last rowid and deletions, followed by the bits
+    header = struct.Struct('<4sIqqqq')
+    magic = b'F2ES'
+
+    def __init__(self, capacity, hashes=None, bits=None):
+        #: number of entries the filter is sized for
+        self.capacity = capacity
+        if bits is None:
+            size = -capacity * math.log(self.error_rate) / math.log(2) ** 2
+            bits = bytearray(int(math.ceil(size / 8)))
+        #: the bit array itself
+        self.bits = bits
+        self.size = len(bits) * 8
+        #: number of hash functions
+        self.hashes = hashes or max(1, int(round(self.size / capacity * math.log(2))))
+        #: number of entries added
+        self.count = 0
+        #: ``rowid`` of the last cache entry added
+        self.last_rowid = 0
+        #: number of deletions from the cache when the filter was built
+        self.deletes = 0
+        #: :attr:`count` when the filter was loaded or saved
+        self.saved_count = 0
+
+    def positions(self, feed, guid):
+        """the bits of the given entry, using double hashing"""
+        digest = hashlib.blake2b(('%s\0%s' % (feed, guid)).encode('utf-8', 'surrogatepass'),
+                                 digest_size=16).digest()
+        first, second = struct.unpack('<QQ', digest)
+        for i in range(self.hashes):
+            yield (first + i * second) % self.size
+
+    def add(self, feed, guid):
+        for position in self.positions(feed, guid):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, entry):
+        """check a ``(feed, guid)`` tuple
+
+        >>> seen_filter = SeenFilter(100)
+        >>> seen_filter.add('feed', 'guid')
+        >>> ('feed', 'guid') in seen_filter, ('feed', 'other') in seen_filter
+        (True, False)
+        """
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self.positions(*entry))
+
+    @classmethod
+    def load(cls, path):
+        """load the filter saved in ``path``
+
+        :return: the :class:`SeenFilter`, or None if the file is
+                 missing or invalid
+        """
+        try:
+            with open(path, 'rb') as fp:
+                data = fp.read()
+        except OSError:
+            return None
+        try:
+            magic, hashes, capacity, count, last_rowid, deletes = cls.header.unpack_from(data)
+        except struct.error:
+            magic = None
+        if magic != cls.magic:
+            logging.warning('ignoring invalid filter %s', path)
+            return None
+        seen_filter = cls(capacity, hashes, bytearray(data[cls.header.size:]))
+        seen_filter.count = seen_filter.saved_count = count
+        seen_filter.last_rowid = last_rowid
+        seen_filter.deletes = deletes
+        return seen_filter
+
+    def save(self, path):
+        """save the filter in ``path``, atomically"""
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as fp:
+            fp.write(self.header.pack(self.magic, self.hashes, self.capacity, self.count,
+                                      self.last_rowid, self.deletes))
+            fp.write(self.bits)
+        os.replace(tmp, path)
+        self.saved_count = self.count
+
+
 class FeedItemCacheStorage(SqliteStorage):
-    sql = '''CREATE TABLE IF NOT EXISTS
-             feedcache (name text, guid text,
-             PRIMARY KEY (name, guid))'''
     record = namedtuple('record', 'name guid')
     table_name = 'feedcache'
     key_name = 'guid'
     value_name = 'name'
+    #: number of GUIDs looked up at once by :func:`seen`, below the
+    #: default SQLite limit of 999 query parameters
+    batch_size = 500
+    #: check a :class:`SeenFilter` before looking GUIDs up in
+    #: :func:`seen`. set with the ``--seen-filter`` option.
+    use_filter = False
+    #: the filters loaded in this process, indexed by path
+    filters: Dict[str, SeenFilter] = {}
+    #: paths of the filters synced with the database in this run, see
+    #: :func:`start_run`
+    synced_filters: Set[str] = set()
+    #: the current run, see :func:`start_run`
+    run = None
+    #: number of entries added to a filter after which it is saved
+    filter_save_entries = 1000
+    #: minimum delay, in seconds, between two updates of the
+    #: ``last_seen`` timestamp of an entry by :func:`seen`, to avoid
+    #: writing to the database on every run
+    last_seen_resolution = 24 * 60 * 60
 
     def __init__(self, path, feed=None, guid=None):
         self.feed = feed
-        if guid is None:
-            self.guid = '%'
-        else:
-            self.guid = '%' + guid + '%'
+        self.guid = guid
         super().__init__(path)
 
     def __repr__(self):
         return 'FeedItemCacheStorage("%s", "%s", "%s")' % (self.path, self.feed, self.guid)
 
     def add(self, guid):
+        """add the GUID to the cache, or mark it as seen now
+
+        the ``first_seen`` and ``last_seen`` timestamps of the entry
+        are recorded, see :func:`prune`.
+        """
         assert self.feed
-        self.set(guid, self.feed)
+        now = time.time()
+        with self.connection() as con:
+            cur = con.execute("""INSERT OR IGNORE INTO feedcache (name, guid, first_seen, last_seen)
+                                 VALUES (?, ?, ?, ?)""", (self.feed, guid, now, now))
+            if not cur.rowcount:
+                con.execute("""UPDATE feedcache SET last_seen=? WHERE name=? AND guid=?""",
+                            (now, self.feed, guid))
+        if self.path in self.synced_filters:
+            # the entry is added again on the next sync, but its
+            # rowid cannot be skipped, as other processes may have
+            # added entries before it
+            self.filters[self.path].add(self.feed, guid)
 
     def remove(self, guid):
-        self.delete(guid)
+        '''override base class to remove only from the specified feed'''
+        if self.feed is None:
+            self.delete(guid)
+            return
+        with self.connection() as con:
+            con.execute("""DELETE FROM feedcache WHERE name=? AND guid=?""",
+                        (self.feed, guid))
+
+    def seen(self, guids):
+        """return the given GUIDs that are already in the cache
+
+        this is equivalent to checking each GUID with ``in``, but
+        does a single query for every :attr:`batch_size` GUIDs
+        instead of one query per GUID.
+
+        if :attr:`use_filter` is set, GUIDs that are definitely not in
+        the cache, according to the :class:`SeenFilter`, are not
+        looked up. the filter is synced with the database on its
+        first use in each run, see :func:`start_run`, and is then
+        checked without any query.
+
+        the ``last_seen`` timestamp of the GUIDs found is also updated,
+        if it is older than :attr:`last_seen_resolution`, as the items
+        are still in the feed.
+
+        :param guids: an iterable of GUIDs to look for
+
+        :return set: the subset of ``guids`` found in the cache
+        """
+        guids = list(set(guids))
+        if self.use_filter and self.feed is not None and guids:
+            if self.path in self.synced_filters:
+                seen_filter = self.filters[self.path]
+            else:
+                seen_filter = self.update_filter()
+            guids = [guid for guid in guids if (self.feed, guid) in seen_filter]
+            if not guids:
+                return set()
+        found = set()
+        stale = []
+        now = time.time()
+        with self.connection(commit=False) as con:
+            for i in range(0, len(guids), self.batch_size):
+                batch = guids[i:i + self.batch_size]
+                sql = "SELECT guid, last_seen FROM feedcache WHERE guid IN (%s)" % ', '.join('?' * len(batch))
+                if self.feed is not None:
+                    sql += " AND name=?"
+                    batch.append(self.feed)
+                for guid, last_seen in con.execute(sql, batch):
+                    found.add(guid)
+                    if (last_seen or 0) < now - self.last_seen_resolution:
+                        stale.append(guid)
+        if stale and self.feed is not None:
+            with self.connection() as con:
+                for i in range(0, len(stale), self.batch_size):
+                    batch = stale[i:i + self.batch_size]
+                    con.execute("UPDATE feedcache SET last_seen=? WHERE name=? AND guid IN (%s)"
+                                % ', '.join('?' * len(batch)), [now, self.feed] + batch)
+        return found
+
+    def prune(self, cutoff, keep=0, dry_run=False):
+        """remove the entries of the feed not seen since ``cutoff``
+
+        entries are marked as seen when added, and when found again
+        in the feed by :func:`seen`.
+
+        :param float cutoff: timestamp before which entries are removed
+
+        :param int keep: number of latest entries of the feed that are
+                         kept regardless, so that they are not
+                         delivered again if they are still in the feed
+
+        :param bool dry_run: only count the entries to remove
+
+        :return int: the number of entries removed
+        """
+        assert self.feed
+        with self.connection(commit=False) as con:
+            row = con.execute("""SELECT rowid FROM feedcache WHERE name=?
+                                 ORDER BY rowid DESC LIMIT 1 OFFSET ?""",
+                              (self.feed, keep)).fetchone()
+        if row is None:
+            return 0
+        condition = "WHERE name=? AND rowid <= ? AND last_seen < ?"
+        params = (self.feed, row[0], cutoff)
+        if dry_run:
+            with self.connection(commit=False) as con:
+                return con.execute("SELECT count(*) FROM feedcache " + condition, params).fetchone()[0]
+        with self.connection() as con:
+            return con.execute("DELETE FROM feedcache " + condition, params).rowcount
+
+    def names(self):
+        """the names of all the feeds in the cache"""
+        with self.connection(commit=False) as con:
+            return [row[0] for row in con.execute("SELECT DISTINCT name FROM feedcache")]
+
+    def update_filter(self):
+        """load the :class:`SeenFilter` and update it with the cache
+
+        the filter is rebuilt if cache entries were deleted since it
+        was built, or if it has more entries than it was sized for.
+
+        :return: the :class:`SeenFilter`
+        """
+        path = self.path + '.seen'
+        seen_filter = self.filters.get(self.path) or SeenFilter.load(path)
+        rebuilt = False
+        with self.connection(commit=False) as con:
+            while True:
+                deletes = con.execute('SELECT deletes FROM feedcache_changes').fetchone()[0]
+                if (seen_filter is None or seen_filter.deletes != deletes
+                        or seen_filter.count > seen_filter.capacity):
+                    count = con.execute('SELECT count(*) FROM feedcache').fetchone()[0]
+                    logging.info('building filter of %d cache entries', count)
+                    seen_filter = SeenFilter(max(2 * count, SeenFilter.min_capacity))
+                    seen_filter.deletes = deletes
+                    rebuilt = True
+                for rowid, name, guid in con.execute("""SELECT rowid, name, guid FROM feedcache
+                                                        WHERE rowid > ? ORDER BY rowid""",
+                                                     (seen_filter.last_rowid,)):
+                    seen_filter.add(name, guid)
+                    seen_filter.last_rowid = rowid
+                if con.execute('SELECT deletes FROM feedcache_changes').fetchone()[0] == deletes:
+                    break
+                # entries were deleted meanwhile, start over
+                seen_filter = None
+        self.filters[self.path] = seen_filter
+        self.synced_filters.add(self.path)
+        if rebuilt or seen_filter.count - seen_filter.saved_count >= self.filter_save_entries:
+            seen_filter.save(path)
+        return seen_filter
+
+    @classmethod
+    def start_run(cls, run):
+        """sync the filters with the database again on their next use
+
+        entries added by this process are added to its filters as
+        well, but not those added by other processes, so this must be
+        called at the start of every run, in every process. runs are
+        numbered, so that pool workers can call this for every feed
+        they process, and only sync once per run.
+
+        :param int run: the number of the run
+        """
+        if run != cls.run:
+            cls.run = run
+            cls.synced_filters.clear()
+
+    def search(self, name='%', guid='%'):
+        """search the cache with patterns
+
+        unlike the other methods, which look for exact feed names,
+        this matches feed names and GUIDs using the SQL ``LIKE``
+        operator, so it cannot use indexes and should be used only
+        for interactive queries.
+
+        :param str name: ``LIKE`` pattern to match feed names against
+        :param str guid: ``LIKE`` pattern to match GUIDs against
+
+        :return: a cursor returning :class:`sqlite3.Row` objects
+        """
+        with self.connection(commit=False) as con:
+            cur = con.cursor()
+            cur.row_factory = sqlite3.Row
+            return cur.execute("""SELECT * FROM feedcache WHERE name LIKE ? AND guid LIKE ?""",
+                               (name, guid))
 
     def __contains__(self, guid):
         '''override base class to look only in the specified feed'''
-        if self.feed is None:
-            pattern = '%'
-        else:
-            pattern = self.feed
         with self.connection(commit=False) as con:
-            cur = con.execute("""SELECT * FROM feedcache WHERE name LIKE ? AND guid=?""",
-                              (pattern, guid))
+            if self.feed is None:
+                cur = con.execute("""SELECT 1 FROM feedcache WHERE guid=?""", (guid,))
+            else:
+                cur = con.execute("""SELECT 1 FROM feedcache WHERE name=? AND guid=?""",
+                                  (self.feed, guid))
             return cur.fetchone() is not None
 
     def __iter__(self):
-        '''override base class to look only in the specified feed'''
-        if self.feed is None:
-            pattern = '%'
-        else:
-            pattern = self.feed
+        '''override base class to look only in the specified feed
+
+        if a ``guid`` was provided in the constructor, only entries
+        with a GUID containing that string are returned.
+        '''
+        sql = "SELECT * FROM feedcache"
+        conditions = []
+        params = []
+        if self.feed is not None:
+            conditions.append("name=?")
+            params.append(self.feed)
+        if self.guid is not None:
+            conditions.append("guid LIKE ? ESCAPE '\\'")
+            params.append('%' + re.sub(r'([%_\\])', r'\\\1', self.guid) + '%')
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
         with self.connection(commit=False) as con:
             cur = con.cursor()
             cur.row_factory = sqlite3.Row
-            return cur.execute("""SELECT * from feedcache WHERE name LIKE ? AND guid LIKE ?""",
-                               (pattern, self.guid))
+            return cur.execute(sql, params)
 
 
 class FeedContentCacheStorage(SqliteStorage):
-    sql = '''CREATE TABLE IF NOT EXISTS
-             content (key, value,
-             PRIMARY KEY (key))'''
     table_name = 'content'
+
+
+class FeedStateStorage(SqliteStorage):
+    """per-feed state kept between runs
+
+    this currently stores the ``ETag`` and ``Last-Modified`` headers
+    of the last response, used for conditional requests, a
+    ``digest`` of the last body, to detect unchanged feeds, and the
+    polling schedule of the feed (``last_fetch``, ``last_new_item``,
+    ``interval`` and ``next_fetch``) and its recent failures
+    (``failures``, ``last_error``, ``last_failure`` and
+    ``paused``) and where it permanently moved (``redirect_url``,
+    valid as long as the configured URL is ``redirect_from``), and
+    when all its items were last looked up in the cache
+    (``last_checked``). each column
+    of the ``feedstate`` table is a key in the dicts returned by
+    :func:`load` and accepted by :func:`save`.
+    """
+    table_name = 'feedstate'
+    key_name = 'name'
+
+    def __init__(self, path, feed):
+        self.feed = feed
+        super().__init__(path)
+
+    def __repr__(self):
+        return 'FeedStateStorage("%s", "%s")' % (self.path, self.feed)
+
+    def load(self):
+        """return the state of the feed as a dict, empty if unknown"""
+        with self.connection(commit=False) as con:
+            cur = con.cursor()
+            cur.row_factory = sqlite3.Row
+            row = cur.execute("SELECT * FROM feedstate WHERE name=?", (self.feed,)).fetchone()
+        if row is None:
+            return {}
+        state = dict(row)
+        del state['name']
+        return state
+
+    def save(self, **fields):
+        """update the given fields of the feed state"""
+        if not fields:
+            return
+        columns = sorted(fields)
+        with self.transaction() as con:
+            con.execute("INSERT OR IGNORE INTO feedstate (name) VALUES (?)", (self.feed,))
+            con.execute("UPDATE feedstate SET %s WHERE name=?"
+                        % ', '.join('`%s`=?' % column for column in columns),
+                        [fields[column] for column in columns] + [self.feed])
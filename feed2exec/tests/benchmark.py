@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+'''measure how fast the feeds of the test suite are parsed
+
+this compares the normal parser with the one used for ``trusted``
+feeds, which does not sanitize HTML, and with the ``lxml`` parser
+(see :mod:`feed2exec.fastparse`). run it with::
+
+  python3 -m feed2exec.tests.benchmark
+'''
+
+from __future__ import division, absolute_import
+from __future__ import print_function
+
+from glob import glob
+import os.path
+import timeit
+from typing import Any, Dict, Tuple
+
+from feed2exec.model import Feed
+import feed2exec.utils as utils
+
+
+#: feed settings compared in the benchmark
+MODES: Tuple[Tuple[str, Dict[str, Any]], ...] = (
+    ('normal', {}),
+    ('trusted', {'trusted': True}),
+    ('lxml', {'parser': 'lxml'}),
+)
+
+
+def benchmark(path, number=10):
+    """parse the given file ``number`` times in each of the :data:`MODES`
+
+    :return tuple: the time, in seconds, of a single parse in each
+                   mode
+    """
+    with open(path, 'rb') as fp:
+        body = fp.read()
+    results = []
+    for _, settings in MODES:
+        feed = Feed(os.path.basename(path), dict(settings, url='file://' + path))
+        # warm up, e.g. for the date handler
+        feed.parse(body)
+        results.append(timeit.timeit(lambda: feed.parse(body), number=number) / number)
+    return tuple(results)
+
+
+def main():
+    totals = [0] * len(MODES)
+    print('%-25s' % 'feed' + ''.join('%10s %7s' % (name, '') for name, _ in MODES))
+    for path in sorted(glob(utils.find_test_file('*.xml'))) + ['total']:
+        if path == 'total':
+            times = totals
+        else:
+            times = benchmark(path)
+            totals = [total + t for total, t in zip(totals, times)]
+        print('%-25s' % os.path.basename(path)
+              + ''.join('%8.2fms %6.1fx' % (t * 1000, times[0] / t) for t in times))
+
+
+if __name__ == '__main__':
+    main()
@@ -19,10 +19,26 @@
 from __future__ import division, absolute_import
 from __future__ import print_function
 
-from feed2exec.model import (FeedConfStorage, FeedItemCacheStorage, Feed)
+import collections
+import http.server
+import io
+import multiprocessing
+import os
+import pickle
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+from feed2exec.model import (FeedConfStorage, FeedItemCacheStorage, FeedStateStorage,
+                             Feed, SeenFilter, SqliteStorage)
+import feed2exec.controller
+import feed2exec.fastparse
 import feed2exec.plugins.echo
 import feed2exec.utils as utils
 import pytest
+import requests
 
 # XXX: bypass the Feed constructor so we don't create the cache
 # database in ~/.cache/feed2exec.db by mistake during tests.
@@ -134,10 +150,268 @@ def test_cache(feed_manager):
         assert False, 'failed to iterate through storage'  # pragma: nocover
     for item in FeedItemCacheStorage(db_path, feed=test_data['name'], guid='guid'):
         assert 'another' not in item['guid']
+    assert set(['guid', 'another']) == st.seen(['guid', 'another', 'unknown'])
+    assert set(['guid']) == tmp.seen(['guid']), 'bulk lookup across feeds'
+    assert set() == FeedItemCacheStorage(db_path, feed='unknown').seen(['guid'])
+    st.batch_size = 1
+    assert set(['guid', 'another']) == st.seen(['guid', 'another', 'unknown'])
     st.remove('guid')
     assert 'guid' not in st
 
 
+def test_cache_exact(tmpdir):
+    db_path = str(tmpdir.join('feed2exec.db'))
+    FeedItemCacheStorage(db_path, feed='100%_real').add('guid')
+    for name in ('100%', '100%_rea_', '%'):
+        assert 'guid' not in FeedItemCacheStorage(db_path, feed=name), 'no pattern matching'
+        assert not FeedItemCacheStorage(db_path, feed=name).seen(['guid'])
+        assert not list(FeedItemCacheStorage(db_path, feed=name))
+    assert 'guid' in FeedItemCacheStorage(db_path, feed='100%_real')
+    assert 1 == len(list(FeedItemCacheStorage(db_path, guid='gu')))
+    assert 0 == len(list(FeedItemCacheStorage(db_path, guid='g%')))
+    st = FeedItemCacheStorage(db_path)
+    assert ['100%_real'] == [row['name'] for row in st.search(name='100%')]
+    assert [] == list(st.search(guid='foo%'))
+    FeedItemCacheStorage(db_path, feed='other').remove('guid')
+    assert 'guid' in st, 'remove only looks in the given feed'
+
+
+def test_cache_transaction(tmpdir):
+    db_path = str(tmpdir.join('feed2exec.db'))
+    st = FeedItemCacheStorage(db_path, feed='test')
+    with st.transaction():
+        st.add('first')
+        with st.transaction():
+            st.add('second')
+        other = sqlite3.connect(db_path)
+        count = other.execute('SELECT COUNT(*) FROM feedcache').fetchone()[0]
+        other.close()
+        assert 0 == count, 'nothing committed before the end of the transaction'
+    assert set(['first', 'second']) == st.seen(['first', 'second'])
+    with pytest.raises(RuntimeError):
+        with st.transaction():
+            st.add('third')
+            raise RuntimeError('test')
+    assert 'third' not in st, 'changes rolled back on errors'
+    st.add('fourth')
+    assert 'fourth' in st, 'commits work again after the transaction'
+
+
+def test_dispatch_batch(feed_manager, monkeypatch):
+    monkeypatch.setattr(feed2exec.controller, 'CACHE_BATCH_SIZE', 2)
+    batches = []
+    cache_add = feed_manager.cache_add
+    monkeypatch.setattr(feed_manager, 'cache_add',
+                        lambda cache, guids, lock=None: batches.append(len(guids))
+                        or cache_add(cache, guids, lock))
+    feed = Feed(test_sample['name'], test_sample)
+    body = feed_manager.fetch_one(feed)
+    feed_manager.dispatch(feed, feed.parse(body))
+    cache = FeedItemCacheStorage(feed_manager.db_path, feed=test_sample['name'])
+    assert sum(batches) == len(list(cache))
+    assert max(batches) <= 2
+
+
+def rss(guids, trailer=b'</channel></rss>'):
+    """a RSS feed with items of the given GUIDs"""
+    items = b''.join(b'<item><title>%s</title><guid>%s</guid></item>' % (guid, guid)
+                     for guid in guids)
+    return b'<rss version="2.0"><channel><title>test</title>' + items + trailer
+
+
+def test_seen_limit(feed_manager, monkeypatch, caplog):
+    monkeypatch.setattr(feed2exec.controller, 'DEFAULT_SEEN_LIMIT', 3)
+    delivered = []
+    monkeypatch.setattr(feed2exec.plugins, 'output',
+                        lambda feed, item, **kwargs: delivered.append(item['id']))
+    guids = [b'%d' % i for i in range(20, 0, -1)]
+    for settings in ({}, {'parser': 'lxml'}):
+        feed = Feed('seen-limit', dict(settings, url='file:///dev/null'))
+        for guid in guids:
+            FeedItemCacheStorage(feed_manager.db_path, feed=feed['name']).add(guid.decode())
+        # a new item on top, and an old one that was missed
+        body = rss([b'21'] + guids + [b'unordered'])
+        del delivered[:]
+        feed_manager.dispatch(feed, feed.parse(body, lazy=True))
+        assert ['21'] == delivered
+        feed = Feed('seen-limit', dict(settings, url='file:///dev/null', seen_limit='0'))
+        feed_manager.dispatch(feed, feed.parse(body, lazy=True))
+        assert ['21', 'unordered'] == delivered
+        FeedItemCacheStorage(feed_manager.db_path, feed=feed['name']).remove('21')
+        FeedItemCacheStorage(feed_manager.db_path, feed=feed['name']).remove('unordered')
+    # invalid limits fall back to the default
+    feed = Feed('seen-limit', {'url': 'file:///dev/null', 'seen_limit': 'abc'})
+    del delivered[:]
+    feed_manager.dispatch(feed, feed.parse(rss([b'21'] + guids + [b'unordered']), lazy=True))
+    assert ['21'] == delivered
+    assert 'invalid value for seen_limit in feed seen-limit' in caplog.text
+    # with the lxml parser, the rest of the feed is not even parsed
+    feed = Feed('seen-limit', {'url': 'file:///dev/null', 'parser': 'lxml'})
+    data = feed.parse(rss([b'22'] + guids, trailer=b'<item><broken'), lazy=True)
+    del delivered[:]
+    feed_manager.dispatch(feed, data)
+    assert ['22'] == delivered
+    assert 'using feedparser' not in caplog.text
+    # ... unless needed
+    feed = Feed('seen-limit', {'url': 'file:///dev/null', 'parser': 'lxml',
+                               'seen_limit': '0'})
+    feed_manager.dispatch(feed, feed.parse(rss([b'23'] + guids + [b'24'], trailer=b'</channel>'),
+                                           lazy=True))
+    assert ['22', '23', '24'] == delivered
+    assert 'cannot be parsed with lxml after 22 entries' in caplog.text
+
+
+def test_parse_new(feed_manager):
+    cache = FeedItemCacheStorage(feed_manager.db_path, feed='parse-new')
+    for guid in ('1', '2'):
+        cache.add(guid)
+    body = rss([b'3', b'2', b'1'])
+    feed = Feed('parse-new', {'url': 'file:///dev/null'})
+    data = feed2exec.controller.parse_new(feed, body, feed_manager.db_path)
+    assert ['3'] == [item['id'] for item in data['entries']]
+    assert 'test' == data['feed']['title']
+    data = feed2exec.controller.parse_new(feed, body, feed_manager.db_path, force=True)
+    assert ['3', '2', '1'] == [item['id'] for item in data['entries']]
+    # filters may change GUIDs or skip items, so everything is kept
+    feed = Feed('parse-new', {'url': 'file:///dev/null', 'parser': 'lxml',
+                              'filter': 'feed2exec.plugins.echo'})
+    data = feed2exec.controller.parse_new(feed, body, feed_manager.db_path)
+    assert ['3', '2', '1'] == [item['id'] for item in data['entries']]
+    pickle.dumps(data)
+
+
+def test_seen_filter(tmpdir, monkeypatch, caplog):
+    monkeypatch.setattr(FeedItemCacheStorage, 'use_filter', True)
+    monkeypatch.setattr(FeedItemCacheStorage, 'filters', {})
+    monkeypatch.setattr(FeedItemCacheStorage, 'synced_filters', set())
+    monkeypatch.setattr(FeedItemCacheStorage, 'run', None)
+    FeedItemCacheStorage.start_run(1)
+    db_path = str(tmpdir.join('feed2exec.db'))
+    cache = FeedItemCacheStorage(db_path, feed='test')
+    for guid in ('1', '2'):
+        cache.add(guid)
+    FeedItemCacheStorage(db_path, feed='other').add('3')
+    assert {'1', '2'} == cache.seen(['1', '2', '3'])
+    seen_filter = FeedItemCacheStorage.filters[db_path]
+    assert ('test', '2') in seen_filter
+    assert ('test', '3') not in seen_filter, 'definitely new, not looked up'
+    assert os.path.exists(db_path + '.seen'), 'filter saved after build'
+    # entries added by this process are in the filter
+    cache.add('3')
+    assert ('test', '3') in seen_filter
+    assert {'3'} == cache.seen(['3'])
+    # once synced, definitely new entries are checked without queries
+    with monkeypatch.context() as m:
+        m.setattr(cache, 'connection', None)
+        assert set() == cache.seen(['5', '6'])
+    # entries added by another process are found on the next run
+    with sqlite3.connect(db_path) as con:
+        con.execute("INSERT INTO feedcache (name, guid, last_seen) VALUES ('test', '5', 0)")
+    con.close()
+    assert set() == cache.seen(['5'])
+    FeedItemCacheStorage.start_run(1)
+    assert set() == cache.seen(['5']), 'synced once per run'
+    FeedItemCacheStorage.start_run(2)
+    assert {'5'} == cache.seen(['5'])
+    # the rowid of deleted entries may be reused
+    cache.remove('3')
+    cache.add('4')
+    assert {'4'} == cache.seen(['3', '4'])
+    FeedItemCacheStorage.start_run(3)
+    assert {'4'} == cache.seen(['3', '4'])
+    assert FeedItemCacheStorage.filters[db_path] is not seen_filter, 'rebuilt after deletion'
+    # the saved filter is used by the next run
+    FeedItemCacheStorage.filters.clear()
+    FeedItemCacheStorage.start_run(4)
+    saved = SeenFilter.load(db_path + '.seen')
+    assert ('test', '4') in saved and saved.deletes == 1
+    assert {'1', '4'} == cache.seen(['1', '4', '6'])
+    # ... unless it is corrupted
+    FeedItemCacheStorage.filters.clear()
+    FeedItemCacheStorage.start_run(5)
+    with open(db_path + '.seen', 'wb') as fp:
+        fp.write(b'garbage')
+    assert {'1', '4'} == cache.seen(['1', '4', '6'])
+    assert 'ignoring invalid filter' in caplog.text
+
+
+def add_guids(db_path, name, count):
+    """helper for test_cache_processes, in a separate process"""
+    cache = FeedItemCacheStorage(db_path, feed=name)
+    for i in range(count):
+        cache.add('guid-%d' % i)
+
+
+def test_cache_processes(tmpdir):
+    db_path = str(tmpdir.join('feed2exec.db'))
+    st = FeedItemCacheStorage(db_path)
+    with st.connection() as con:
+        assert 'wal' == con.execute('PRAGMA journal_mode').fetchone()[0]
+        assert SqliteStorage.pragmas['cache_size'] == con.execute('PRAGMA cache_size').fetchone()[0]
+    pool = multiprocessing.Pool(processes=4)
+    results = [pool.apply_async(add_guids, (db_path, 'feed-%d' % i, 50))
+               for i in range(4)]
+    for result in results:
+        result.get()
+    pool.close()
+    pool.join()
+    for i in range(4):
+        assert 50 == len(list(FeedItemCacheStorage(db_path, feed='feed-%d' % i)))
+
+
+def test_cache_fork(tmpdir, monkeypatch):
+    db_path = str(tmpdir.join('feed2exec.db'))
+    st = FeedItemCacheStorage(db_path)
+    with st.connection() as con:
+        parent = con
+    monkeypatch.setattr(os, 'getpid', lambda: -1)
+    with st.connection() as con:
+        assert con is not parent, 'new connection after fork'
+    assert parent in SqliteStorage.orphans, 'inherited connection not closed'
+
+
+def test_migrations(tmpdir):
+    db_path = str(tmpdir.join('feed2exec.db'))
+    # database created before schema versioning
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE feedcache (name text, guid text, PRIMARY KEY (name, guid))")
+    conn.execute("INSERT INTO feedcache VALUES ('test', 'guid')")
+    conn.commit()
+    conn.close()
+    assert 'guid' in FeedItemCacheStorage(db_path, feed='test')
+    with FeedItemCacheStorage(db_path).connection() as conn:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        indexes = [row[1] for row in conn.execute('PRAGMA index_list(feedcache)')]
+    assert len(SqliteStorage.migrations) == version
+    assert 'feedcache_guid' in indexes
+
+
+def test_migrations_race(tmpdir):
+    class RacingConnection(object):
+        """another process migrates right after the version is read"""
+        def __init__(self, conn, other):
+            self.conn = conn
+            self.other = other
+
+        def execute(self, sql):
+            cursor = self.conn.execute(sql)
+            if sql == 'PRAGMA user_version' and self.other is not None:
+                row = cursor.fetchone()
+                other, self.other = self.other, None
+                SqliteStorage.migrate(other)
+                return collections.namedtuple('Cursor', 'fetchone')(lambda: row)
+            return cursor
+
+        def __getattr__(self, name):
+            return getattr(self.conn, name)
+
+    db_path = str(tmpdir.join('feed2exec.db'))
+    sqlite3.connect(db_path).close()
+    conn = sqlite3.connect(db_path)
+    SqliteStorage.migrate(RacingConnection(conn, sqlite3.connect(db_path)))
+    assert len(SqliteStorage.migrations) == conn.execute('PRAGMA user_version').fetchone()[0]
+
+
 def test_fetch(feed_manager):
     feed_manager.conf_storage.add(**test_sample)
 
@@ -171,6 +445,170 @@ def test_fetch_parallel(feed_manager, capfd):
     assert '1 2 3 4' in out
 
 
+def test_shared_body(feed_manager, capfd, monkeypatch):
+    shared_memory = pytest.importorskip('multiprocessing.shared_memory')
+    body = feed2exec.controller.SharedBody.create(b'x' * 100)
+    assert 100 == len(body)
+    assert len(pickle.dumps(body)) < 100, 'body not pickled'
+    assert b'x' * 100 == pickle.loads(pickle.dumps(body)).read()
+    body.unlink()
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=body.name)
+    body.unlink()
+
+    monkeypatch.setattr(feed2exec.controller, 'SHARED_BODY_SIZE', 0)
+    bodies = []
+    create = feed2exec.controller.SharedBody.create
+    monkeypatch.setattr(feed2exec.controller.SharedBody, 'create',
+                        lambda body: bodies.append(create(body)) or bodies[-1])
+    feed_manager.conf_storage.add(**test_sample)
+    for worker_dispatch in (False, True):
+        feed_manager.fetch(parallel=2, force=True, worker_dispatch=worker_dispatch)
+        out, err = capfd.readouterr()
+        assert '1 2 3 4' in out
+    assert 2 == len(bodies)
+    for body in bodies:
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=body.name)
+
+
+SHARED_BODY_SCRIPT = """
+import multiprocessing
+from feed2exec.controller import SharedBody, read_body
+
+if __name__ == '__main__':
+    # workers started before the resource tracker of the parent
+    with multiprocessing.Pool(1) as pool:
+        bodies = [SharedBody.create(b'x' * 100) for _ in range(3)]
+        for body in bodies:
+            assert b'x' * 100 == pool.apply(read_body, (body,))
+            body.unlink()
+    # a worker failing before reading the body
+    SharedBody.create(b'x' * 100).unlink()
+"""
+
+
+def test_shared_body_tracker(tmpdir):
+    pytest.importorskip('multiprocessing.shared_memory')
+    script = tmpdir.join('shared.py')
+    script.write(SHARED_BODY_SCRIPT)
+    proc = subprocess.run([sys.executable, str(script)], stderr=subprocess.PIPE,
+                          universal_newlines=True, timeout=60)
+    assert 0 == proc.returncode, proc.stderr
+    assert 'leaked' not in proc.stderr
+    assert 'Warning' not in proc.stderr
+
+
+def test_fetch_worker_dispatch(feed_manager, capfd):
+    feed_manager.conf_storage.add(**test_sample)
+    feed_manager.fetch(parallel=2, worker_dispatch=True)
+    out, err = capfd.readouterr()
+    assert '1 2 3 4' in out, 'plugins called in workers'
+    cache = FeedItemCacheStorage(feed_manager.db_path, feed=test_sample['name'])
+    assert '7bd204c6-1655-4c27-aeee-53f933c5395f' in cache, 'cache updated by workers'
+    feed_manager.fetch(worker_dispatch=True)
+    out, err = capfd.readouterr()
+    assert '1 2 3 4' not in out, 'workers see the cache'
+
+
+def test_fetch_concurrent(feed_manager):
+    feed_manager.conf_storage.add(**test_sample)
+    feed_manager.conf_storage.add(**test_udd)
+    feeds = list(feed_manager.conf_storage)
+    results = dict((feed['name'], body)
+                   for feed, body in feed_manager.fetch_many(feeds, jobs=4))
+    assert set(results) == set([test_sample['name'], test_udd['name']])
+    assert all(results.values()), 'all feeds fetched'
+
+    feed_manager.fetch(fetch_jobs=4)
+    cache = FeedItemCacheStorage(feed_manager.db_path, feed=test_sample['name'])
+    assert '7bd204c6-1655-4c27-aeee-53f933c5395f' in cache
+    cache = FeedItemCacheStorage(feed_manager.db_path, feed=test_udd['name'])
+    assert len(list(cache)) > 0, 'both feeds dispatched'
+
+
+def test_fetch_cold_session(tmpdir):
+    '''that threads do not use the session before it is configured'''
+    feed_manager = feed2exec.controller.FeedManager(str(tmpdir.join('feed2exec.ini')),
+                                                    str(tmpdir.join('feed2exec.db')))
+    feeds = [Feed('sample-%d' % i, test_sample) for i in range(8)]
+    results = [body for feed, body in feed_manager.fetch_many(feeds, jobs=8)]
+    assert 8 == len(results)
+    assert all(results), 'all feeds fetched'
+
+
+def test_fetch_hosts(feed_manager, monkeypatch):
+    feed_manager.host_jobs = 2
+    feed_manager.host_delay = 0.02
+    feeds = [Feed('a%d' % i, {'url': 'http://a.example.com/%d' % i}) for i in range(6)]
+    feeds += [Feed('b%d' % i, {'url': 'http://b.example.com/%d' % i}) for i in range(2)]
+    lock = threading.Lock()
+    active = collections.Counter()
+    peak = collections.Counter()
+    starts = collections.defaultdict(list)
+
+    def fake_fetch(feed, force=False, deadline=None):
+        host = feed2exec.controller.feed_host(feed)
+        with lock:
+            active[host] += 1
+            peak[host] = max(peak[host], active[host])
+            starts[host].append(time.monotonic())
+        time.sleep(0.05)
+        with lock:
+            active[host] -= 1
+        return b'body'
+
+    monkeypatch.setattr(feed_manager, 'fetch_one', fake_fetch)
+    fetched = [feed['name'] for feed, body in feed_manager.fetch_many(feeds, jobs=4)]
+    assert sorted(fetched) == sorted(feed['name'] for feed in feeds), 'all feeds fetched'
+    assert 2 == peak['a.example.com'], 'concurrent requests per host are limited'
+    delays = [b - a for a, b in zip(starts['a.example.com'], starts['a.example.com'][1:])]
+    assert min(delays) >= 0.01, 'requests to the same host are spaced out'
+    assert fetched.index('b1') < fetched.index('a5'), 'other hosts are not delayed'
+    feed_manager.host_jobs = 3
+    feed_manager.sessionConfig()
+    for adapter in ('http://', 'https://'):
+        adapter = feed_manager.session.adapters[adapter]
+        adapter = getattr(adapter, 'old_adapters', {}).get('https://', adapter)
+        assert 3 == adapter._pool_maxsize, 'connection pool sized for host_jobs'
+
+
+def test_dispatch_ready(feed_manager, monkeypatch):
+    class FakeResult(object):
+        def __init__(self, ready):
+            self._ready = ready
+
+        def ready(self):
+            return self._ready
+
+        def wait(self):
+            self._ready = True
+
+        def get(self):
+            return {'entries': []}
+
+    dispatched = []
+    monkeypatch.setattr(feed_manager, 'dispatch',
+                        lambda feed, *args: dispatched.append(feed['name']))
+    freed = []
+    monkeypatch.setattr(feed2exec.controller, 'free_body', freed.append)
+    pending = [(Feed('slow'), FakeResult(False), b'slow'),
+               (Feed('fast'), FakeResult(True), b'fast')]
+    feed_manager.dispatch_ready(pending, None, False, 1)
+    assert ['fast'] == dispatched, 'completed results are dispatched first'
+    assert [b'fast'] == freed
+    assert 1 == len(pending), 'pending results are kept under the limit'
+    feed_manager.dispatch_ready(pending, None, False, 0)
+    assert ['fast', 'slow'] == dispatched, 'waits for remaining results'
+    assert [b'fast', b'slow'] == freed
+    assert not pending
+    failed = FakeResult(True)
+    failed.get = lambda: 1 / 0
+    with pytest.raises(ZeroDivisionError):
+        feed_manager.dispatch_ready([(Feed('failed'), failed, b'failed')], None, False, 0)
+    assert b'failed' == freed[-1], 'freed when the worker failed'
+
+
 @pytest.mark.xfail(reason="cachecontrol does not know how to chain adapters")
 def test_fetch_cache(feed_manager):
     '''that a second fetch returns no body'''
@@ -189,6 +627,450 @@ def test_fetch_cache(feed_manager):
     assert content is None
 
 
+def test_conditional_get(feed_manager, monkeypatch):
+    headers_sent = []
+
+    def fake_get(url, headers=None, **kwargs):
+        headers_sent.append(headers)
+        resp = requests.Response()
+        if headers.get('If-None-Match') == '"v1"':
+            resp.status_code = 304
+            resp.raw = io.BytesIO(b'')
+        else:
+            resp.status_code = 200
+            resp.raw = io.BytesIO(b'<rss></rss>')
+            resp.headers['ETag'] = '"v1"'
+            resp.headers['Last-Modified'] = 'Thu, 01 Jan 2015 00:00:00 GMT'
+        return resp
+
+    monkeypatch.setattr(feed_manager.session, 'get', fake_get)
+    feed = Feed('conditional', {'url': 'http://example.com/rss'})
+    assert b'<rss></rss>' == feed_manager.fetch_one(feed)
+    assert {} == headers_sent[-1], 'no validators known on first fetch'
+    assert b'<rss></rss>' == feed_manager.fetch_one(Feed('conditional', feed))
+    assert {} == headers_sent[-1], 'validators saved only after processing'
+    feed_manager.save_state(feed)
+    assert feed_manager.fetch_one(Feed('conditional', feed)) is None, '304 skips the feed'
+    assert {'If-None-Match': '"v1"',
+            'If-Modified-Since': 'Thu, 01 Jan 2015 00:00:00 GMT'} == headers_sent[-1]
+    assert feed_manager.fetch_one(Feed('conditional', feed), force=True)
+    assert {} == headers_sent[-1], 'force ignores validators'
+
+
+def test_fetch_timeout(feed_manager, monkeypatch):
+    timeouts = []
+
+    class SlowRaw(object):
+        '''a server sending one byte at a time'''
+        def read(self, size=None):
+            time.sleep(0.01)
+            return b'.'
+
+        def close(self):
+            pass
+
+    def fake_get(url, headers=None, timeout=None, **kwargs):
+        timeouts.append(timeout)
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.raw = SlowRaw()
+        return resp
+
+    monkeypatch.setattr(feed_manager.session, 'get', fake_get)
+    feed = Feed('slow', {'url': 'http://example.com/rss',
+                         'connect_timeout': '1', 'feed_timeout': '0.05'})
+    assert feed_manager.fetch_one(feed) is None, 'slow download aborted'
+    assert (1, feed2exec.controller.DEFAULT_READ_TIMEOUT) == timeouts[-1]
+    assert feed_manager.fetch_one(Feed('slow', {'url': 'http://example.com/rss'}),
+                                  deadline=time.monotonic() + 0.05) is None, \
+        'download aborted at the deadline'
+
+
+@pytest.fixture()
+def http_server():
+    '''a local HTTP server, trickling data on /slow and answering 304
+    on /not-modified and 404 on /not-found, which records the
+    connections it receives'''
+    stopping = threading.Event()
+    connections = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            connections.append(self.client_address)
+            super().setup()
+
+        def do_GET(self):
+            if self.path == '/not-modified':
+                self.send_response(304)
+                self.end_headers()
+                return
+            if self.path == '/not-found':
+                self.send_response(404)
+                self.send_header('Content-Length', '9')
+                self.end_headers()
+                self.wfile.write(b'not found')
+                return
+            self.send_response(200)
+            self.send_header('Content-Length', '1000')
+            self.end_headers()
+            try:
+                while not stopping.wait(0.2):
+                    self.wfile.write(b'.')
+                    self.wfile.flush()
+            except OSError:
+                pass
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.url = 'http://127.0.0.1:%d' % server.server_address[1]
+    server.connections = connections
+    yield server
+    stopping.set()
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_trickle(tmpdir, http_server, caplog):
+    feed_manager = feed2exec.controller.FeedManager(str(tmpdir.join('feed2exec.ini')),
+                                                    str(tmpdir.join('feed2exec.db')))
+    feed = Feed('slow', {'url': http_server.url + '/slow', 'feed_timeout': '0.5'})
+    start = time.monotonic()
+    assert feed_manager.fetch_one(feed) is None, 'trickling download aborted'
+    assert time.monotonic() - start < 5
+    assert 'too long' in feed.state_updates['last_error']
+    # invalid timeouts fall back to the defaults of the manager
+    feed_manager.feed_timeout = 0.5
+    feed = Feed('slow', {'url': http_server.url + '/slow', 'feed_timeout': '2m',
+                         'read_timeout': '-1'})
+    start = time.monotonic()
+    assert feed_manager.fetch_one(feed) is None
+    assert time.monotonic() - start < 5
+    assert 'too long' in feed.state_updates['last_error']
+    assert 'invalid value for feed_timeout in feed slow' in caplog.text
+    assert 'invalid value for read_timeout in feed slow' in caplog.text
+
+    for i in range(4):
+        feed_manager.conf_storage.add(name='slow-%d' % i, url=http_server.url + '/slow')
+    start = time.monotonic()
+    feed_manager.fetch(fetch_jobs=4, deadline=0.5)
+    assert time.monotonic() - start < 5, 'run stopped at the deadline'
+
+
+def test_fetch_keepalive(tmpdir, http_server):
+    feed_manager = feed2exec.controller.FeedManager(str(tmpdir.join('feed2exec.ini')),
+                                                    str(tmpdir.join('feed2exec.db')))
+    for _ in range(5):
+        feed = Feed('not-modified', {'url': http_server.url + '/not-modified'})
+        assert feed_manager.fetch_one(feed) is None
+        assert feed.hints['unchanged']
+    assert 1 == len(http_server.connections), 'connection reused after 304'
+    for _ in range(5):
+        feed = Feed('not-found', {'url': http_server.url + '/not-found'})
+        assert feed_manager.fetch_one(feed) is None
+        assert '404' in feed.state_updates['last_error']
+    assert 1 == len(http_server.connections), 'connection reused after errors'
+
+
+def test_failures(feed_manager, monkeypatch):
+    statuses = []
+    retry_after = []
+
+    def fake_get(url, **kwargs):
+        resp = requests.Response()
+        resp.status_code = statuses.pop(0)
+        resp.url = url
+        resp.raw = io.BytesIO(b'<rss></rss>')
+        if retry_after:
+            resp.headers['Retry-After'] = retry_after.pop(0)
+        return resp
+
+    monkeypatch.setattr(feed_manager.session, 'get', fake_get)
+    monkeypatch.setattr(feed2exec.controller, 'MAX_FAILURES', 2)
+    monkeypatch.setattr(time, 'time', lambda: 1000)
+    feed_manager.conf_storage.add(name='failing', url='http://example.com/rss')
+    storage = FeedStateStorage(feed_manager.db_path, 'failing')
+
+    statuses.append(503)
+    feed_manager.fetch()
+    state = storage.load()
+    assert 1 == state['failures']
+    assert '503' in state['last_error']
+    assert 1000 + feed2exec.controller.BACKOFF_MIN == state['next_fetch']
+    assert not state['paused'], 'transient errors do not pause feeds'
+    feed_manager.fetch()
+    assert not statuses, 'feed skipped during backoff'
+    assert state == storage.load()
+
+    monkeypatch.setattr(time, 'time', lambda: 1000 + feed2exec.controller.BACKOFF_MIN)
+    statuses.append(404)
+    feed_manager.fetch()
+    state = storage.load()
+    assert 2 == state['failures']
+    assert 1000 + 3 * feed2exec.controller.BACKOFF_MIN == state['next_fetch'], \
+        'delay doubles'
+    assert '2 failures' == state['paused'], 'permanent failures pause feeds'
+    assert ['failing'] == [s['name'] for s in feed_manager.status(failing=True)]
+    feed_manager.fetch(force=True)
+    assert not feed_manager.is_due(Feed('failing', {}))
+
+    feed_manager.resume('failing')
+    assert [] == list(feed_manager.status(failing=True))
+    statuses.append(200)
+    feed_manager.fetch(due=True)
+    state = storage.load()
+    assert 0 == state['failures'], 'success resets failures'
+    assert state['last_error'] is None
+
+    statuses.append(429)
+    retry_after.append('7200')
+    feed_manager.fetch(force=True)
+    state = storage.load()
+    assert 1000 + feed2exec.controller.BACKOFF_MIN + 7200 == state['next_fetch'], \
+        'Retry-After longer than the backoff respected'
+    assert not state['paused']
+
+    statuses.append(410)
+    feed_manager.fetch(force=True)
+    assert 'gone' == storage.load()['paused']
+
+
+def test_redirects(feed_manager, monkeypatch):
+    requested = []
+    broken = []
+
+    def response(status, url):
+        resp = requests.Response()
+        resp.status_code = status
+        resp.url = url
+        resp.raw = io.BytesIO(b'<rss></rss>')
+        return resp
+
+    def fake_get(url, **kwargs):
+        requested.append(url)
+        if url == 'http://example.com/rss':
+            resp = response(200, 'https://example.net/final')
+            resp.history = [response(301, 'http://example.com/rss'),
+                            response(308, 'https://example.com/rss'),
+                            response(302, 'https://example.net/rss')]
+            return resp
+        return response(404 if broken else 200, url)
+
+    monkeypatch.setattr(feed_manager.session, 'get', fake_get)
+    feed_manager.conf_storage.add(name='moved', url='http://example.com/rss')
+    feed_manager.fetch()
+    feed_manager.fetch()
+    assert ['http://example.com/rss', 'https://example.net/rss'] == requested, \
+        'only permanent redirects remembered'
+    broken.append(True)
+    feed_manager.fetch(force=True)
+    feed_manager.fetch(force=True)
+    assert 'http://example.com/rss' == requested[-1], 'redirect forgotten on errors'
+
+    broken.pop()
+    feed_manager.fetch(rewrite_redirects=True)
+    assert 'https://example.net/rss' == FeedConfStorage(feed_manager.conf_path)['moved']['url']
+    assert 'https://example.net/rss' == feed_manager.conf_storage['moved']['url']
+
+
+def test_response(feed_manager, monkeypatch):
+    def fake_get(url, **kwargs):
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.url = 'https://example.net/feed/rss'
+        resp.headers['Content-Type'] = 'application/rss+xml; charset=iso-8859-7'
+        resp.encoding = 'iso-8859-7'
+        resp.raw = io.BytesIO(u'''<rss version="2.0"><channel><title>\u03ba\u03b1\u03c6\u03ad\u03c2</title>
+<item><title>post</title><link>/post/1</link></item></channel></rss>'''.encode('iso-8859-7'))
+        return resp
+
+    monkeypatch.setattr(feed_manager.session, 'get', fake_get)
+    feed = Feed('response', {'url': 'http://example.com/rss'})
+    body = feed_manager.fetch_one(feed)
+    assert 'https://example.net/feed/rss' == feed.response.url
+    assert 200 == feed.response.status
+    assert 'iso-8859-7' == feed.response.encoding
+    feed = pickle.loads(pickle.dumps(feed))
+    assert 'https://example.net/feed/rss' == feed.response.url, 'response sent to workers'
+    data = feed.parse(body)
+    assert u'\u03ba\u03b1\u03c6\u03ad\u03c2' == data['feed']['title'], 'declared charset used'
+    item = data['entries'][0]
+    feed.normalize(item)
+    assert 'https://example.net/post/1' == item['link'], 'links relative to the final URL'
+
+
+def test_deadline(feed_manager):
+    feed_manager.conf_storage.add(**test_sample)
+    feed_manager.conf_storage.add(**test_udd)
+    feed_manager.fetch(deadline=0)
+    for feed in (test_sample, test_udd):
+        assert not FeedStateStorage(feed_manager.db_path, feed['name']).load(), \
+            'feeds left for the next run'
+    feed_manager.fetch(deadline=60)
+    for feed in (test_sample, test_udd):
+        assert FeedStateStorage(feed_manager.db_path, feed['name']).load()
+
+
+def test_digest(feed_manager):
+    feed = Feed(test_sample['name'], test_sample)
+    body = feed_manager.fetch_one(feed)
+    assert body
+    assert feed.state_updates['digest']
+    assert feed_manager.fetch_one(Feed(test_sample['name'], test_sample)), \
+        'digest saved only after processing'
+    feed_manager.save_state(feed)
+    assert feed_manager.fetch_one(Feed(test_sample['name'], test_sample)) is None, \
+        'unchanged body is skipped'
+    assert body == feed_manager.fetch_one(Feed(test_sample['name'], test_sample), force=True)
+
+
+def test_refused(feed_manager, monkeypatch, caplog):
+    def fake_get(url, headers=None, **kwargs):
+        resp = requests.Response()
+        resp.url = url
+        if headers.get('If-None-Match') == '"v1"':
+            resp.status_code = 304
+            resp.raw = io.BytesIO(b'')
+        else:
+            resp.status_code = 200
+            resp.raw = io.BytesIO(rss([b'1']))
+            resp.headers['ETag'] = '"v1"'
+        return resp
+
+    calls = []
+    accept = []
+    monkeypatch.setattr(feed_manager.session, 'get', fake_get)
+    monkeypatch.setattr(feed2exec.plugins, 'output',
+                        lambda feed, item, **kwargs: calls.append(item['id']) or bool(accept))
+    feed_manager.conf_storage.add(name='refused', url='http://example.com/rss',
+                                  output='feed2exec.plugins.echo')
+    for _ in range(3):
+        feed_manager.fetch()
+    assert ['1', '1', '1'] == calls, 'refused items retried on every run'
+    assert FeedStateStorage(feed_manager.db_path, 'refused').load()['etag'] is None
+    accept.append(True)
+    for _ in range(2):
+        feed_manager.fetch()
+    assert ['1', '1', '1', '1'] == calls
+    assert '"v1"' == FeedStateStorage(feed_manager.db_path, 'refused').load()['etag']
+    # feeds without output plugin are not retried
+    caplog.set_level('INFO')
+    caplog.clear()
+    monkeypatch.setattr(feed2exec.plugins, 'output', lambda feed, item, **kwargs: False)
+    feed_manager.conf_storage.remove('refused')
+    feed_manager.conf_storage.add(name='no-output', url='http://example.com/rss')
+    for _ in range(2):
+        feed_manager.fetch()
+    assert '"v1"' == FeedStateStorage(feed_manager.db_path, 'no-output').load()['etag']
+    assert 'will retry' not in caplog.text
+
+
+def test_gc_unchanged(feed_manager, monkeypatch):
+    def fake_get(url, headers=None, **kwargs):
+        resp = requests.Response()
+        resp.url = url
+        resp.status_code = 200
+        resp.raw = io.BytesIO(rss(guids))
+        return resp
+
+    day = 24 * 60 * 60
+    now = 1000000000
+    monkeypatch.setattr(time, 'time', lambda: now)
+    monkeypatch.setattr(feed_manager.session, 'get', fake_get)
+    monkeypatch.setattr(feed2exec.plugins, 'output', lambda feed, item, **kwargs: True)
+    feed_manager.conf_storage.add(name='unchanged', url='http://example.com/rss')
+    guids = [b'%d' % i for i in range(20, 0, -1)]
+    feed_manager.fetch()
+    assert now == FeedStateStorage(feed_manager.db_path, 'unchanged').load()['last_checked']
+    # only the first items are looked up, see test_seen_limit
+    now += 60 * 60
+    guids.insert(0, b'21')
+    feed_manager.fetch()
+    # ... and none when the feed is unchanged
+    now += 200 * day
+    feed_manager.fetch()
+    assert {} == feed_manager.gc(max_age=180 * day, keep=2), 'items still in the feed are kept'
+    # all items are looked up once in a while, to find removed ones
+    guids.remove(b'20')
+    feed_manager.fetch()
+    assert now == FeedStateStorage(feed_manager.db_path, 'unchanged').load()['last_checked']
+    assert {'unchanged': 1} == feed_manager.gc(max_age=180 * day, keep=2)
+    assert 20 == len(list(FeedItemCacheStorage(feed_manager.db_path, feed='unchanged')))
+
+
+def test_schedule(feed_manager, monkeypatch):
+    feed_manager.conf_storage.add(**test_sample)
+    feed_manager.conf_storage.set(test_sample['name'], 'max_interval', '200000')
+    feed_manager.fetch(due=True)
+    storage = FeedStateStorage(feed_manager.db_path, test_sample['name'])
+    state = storage.load()
+    assert state['last_new_item'] == state['last_fetch'], 'new items found'
+    assert 1800 * 60 == state['interval'], 'ttl respected'
+    assert state['last_fetch'] + state['interval'] == state['next_fetch']
+    assert not feed_manager.is_due(test_sample)
+
+    feed_manager.fetch(due=True)
+    assert state == storage.load(), 'feed skipped when not due'
+
+    now = state['next_fetch'] + 1
+    monkeypatch.setattr(time, 'time', lambda: now)
+    assert feed_manager.is_due(test_sample)
+    feed_manager.fetch(due=True)
+    new_state = storage.load()
+    assert now == new_state['last_fetch'], 'fetched when due'
+    assert state['last_new_item'] == new_state['last_new_item'], 'no new items'
+    assert state['interval'] * feed2exec.controller.INTERVAL_FACTOR == new_state['interval'], \
+        'interval grows for unchanged feeds'
+
+
+def test_schedule_hints(feed_manager, monkeypatch):
+    monkeypatch.setattr(time, 'time', lambda: 1000)
+    feed = Feed('hints', {'min_interval': '60', 'max_interval': '600'})
+    feed.hints['max_age'] = 300
+    feed_manager.schedule(feed, new_items=1)
+    assert 300 == feed.state_updates['interval'], 'max-age respected'
+    feed_manager.schedule(feed, data={'feed': {'ttl': '60'}})
+    assert 600 == feed.state_updates['interval'], 'ttl capped by max_interval'
+    feed.hints = {'retry_after': 3600}
+    feed_manager.schedule(feed, new_items=1)
+    assert 60 == feed.state_updates['interval'], 'min_interval respected'
+    assert 1000 + 3600 == feed.state_updates['next_fetch'], 'Retry-After delays next fetch'
+    feed = Feed('typo', {'min_interval': '1h', 'max_interval': '1d'})
+    feed_manager.schedule(feed, new_items=1)
+    assert feed2exec.controller.DEFAULT_MIN_INTERVAL == feed.state_updates['interval'], \
+        'invalid intervals ignored'
+
+
+def test_serve(feed_manager, monkeypatch):
+    feed_manager.conf_storage.add(**test_sample)
+    fetch = feed_manager.fetch
+    runs = []
+
+    def fetch_and_signal(*args, **kwargs):
+        runs.append(sorted(feed['name'] for feed in feed_manager.conf_storage))
+        fetch(*args, **kwargs)
+        if len(runs) == 1:
+            # simulate SIGHUP after an edit of the configuration
+            FeedConfStorage(feed_manager.conf_path).add(**test_nasa)
+            feed_manager.reload()
+        else:
+            # simulate SIGTERM
+            feed_manager.stop()
+
+    monkeypatch.setattr(feed_manager, 'fetch', fetch_and_signal)
+    feed_manager.serve()
+    assert [['sample'], ['nasa-breaking-news', 'sample']] == runs, \
+        'configuration reloaded, no sleep after signals'
+    assert FeedStateStorage(feed_manager.db_path, test_nasa['name']).load().get('next_fetch'), \
+        'new feed fetched after reload'
+    assert 0 < feed_manager.next_due()
+
+
 def test_normalize(feed_manager):
     '''black box testing for :func:feeds.normalize_item()'''
     data = test_udd.parse(feed_manager.session.get(test_udd['url']).content)
@@ -209,6 +1091,85 @@ def test_normalize(feed_manager):
         assert item.get('updated_parsed')
 
 
+def test_trusted():
+    body = b'''<rss version="2.0"><channel><title>trusted</title><item>
+<description>&lt;script&gt;alert(1)&lt;/script&gt;&lt;p&gt;hello&lt;/p&gt;</description>
+</item></channel></rss>'''
+    data = Feed('untrusted', {'url': 'file:///dev/null'}).parse(body)
+    assert '<script>' not in data['entries'][0]['summary'], 'HTML sanitized'
+    data = Feed('trusted', {'url': 'file:///dev/null', 'trusted': 'True'}).parse(body)
+    assert '<script>alert(1)</script><p>hello</p>' == data['entries'][0]['summary']
+    for value in ('false', 'no', 'off', '0', 'garbage'):
+        data = Feed('untrusted', {'url': 'file:///dev/null', 'trusted': value}).parse(body)
+        assert '<script>' not in data['entries'][0]['summary'], 'HTML sanitized with %s' % value
+
+
+#: item fields documented as supported by the lxml parser
+FASTPARSE_FIELDS = ('id', 'title', 'link', 'published', 'published_parsed',
+                    'updated', 'updated_parsed', 'author', 'summary', 'content',
+                    'enclosures')
+
+#: an Atom podcast, as the test files have no Atom enclosures
+ATOM_PODCAST = b'''<feed xmlns="http://www.w3.org/2005/Atom"><title>podcast</title>
+<updated>2020-01-02T00:00:00Z</updated><id>urn:podcast</id>
+<entry><id>urn:episode:1</id><title>episode</title><updated>2020-01-02T00:00:00Z</updated>
+<link href="http://example.com/1"/>
+<link rel="enclosure" href="http://example.com/1.mp3" type="audio/mpeg" length="1234"/>
+<link rel="enclosure" href="http://example.com/1.ogg"/></entry></feed>'''
+
+
+def test_fastparse():
+    bodies = []
+    for path in ('breaking_news.xml', 'planet-debian.xml', 'restic.xml',
+                 'rsswithpermalink.xml', 'sample.xml', 'udd.xml', 'weird-dates.xml'):
+        with open(utils.find_test_file(path), 'rb') as fp:
+            bodies.append((path, fp.read()))
+    bodies.append(('atom podcast', ATOM_PODCAST))
+    for path, body in bodies:
+        expected = Feed(path, {'url': 'file:///dev/null', 'trusted': 'True'}).parse(body)
+        data = feed2exec.fastparse.parse(body)
+        assert expected['version'] == data['version']
+        for key, value in data['feed'].items():
+            assert expected['feed'].get(key) == value, 'same %s in %s' % (key, path)
+        assert len(expected['entries']) == len(data['entries'])
+        for item, entry in zip(expected['entries'], data['entries']):
+            assert entry.get('title')
+            for key, value in entry.items():
+                assert item.get(key) == value, 'same %s in %s' % (key, path)
+            for key in FASTPARSE_FIELDS:
+                if dict.__contains__(item, key) or (key == 'enclosures' and item.get(key)):
+                    assert entry.get(key) == item.get(key), 'same %s in %s' % (key, path)
+    data = feed2exec.fastparse.parse(ATOM_PODCAST)
+    assert 'http://example.com/1.mp3' == data['entries'][0]['enclosures'][0]['href']
+
+
+def test_fastparse_fallback(caplog):
+    caplog.set_level('INFO')
+    feed = Feed('fallback', {'url': 'file:///dev/null', 'parser': 'lxml'})
+    body = b'''<rss version="2.0"><channel><title>broken&nbsp;feed</title><item>
+<guid>1</guid><description>&lt;p&gt;hello&lt;/p&gt;</description>
+</item></channel></rss>'''
+    with pytest.raises(feed2exec.fastparse.UnsupportedFeed):
+        feed2exec.fastparse.parse(body)
+    data = feed.parse(body)
+    assert 'using feedparser' in caplog.text
+    assert data['bozo'], 'malformed feed parsed by feedparser'
+    assert '1' == data['entries'][0]['id']
+    assert '<p>hello</p>' == data['entries'][0]['summary']
+    caplog.clear()
+    feed = Feed('fallback', {'url': 'file:///dev/null', 'parser': 'lxml'})
+    data = feed.parse(body.replace(b'&nbsp;', b' '))
+    assert 'using feedparser' not in caplog.text
+    assert 'broken feed' == feed['title']
+    assert '<p>hello</p>' == data['entries'][0]['summary']
+
+
+def test_pickle():
+    feed = pickle.loads(pickle.dumps(test_sample))
+    assert type(feed) is Feed
+    assert dict(test_sample) == dict(feed), 'keys are not renamed'
+
+
 def test_config(tmpdir):
     conf_path = tmpdir.join('feed2exec.ini')
     conf = FeedConfStorage(str(conf_path))
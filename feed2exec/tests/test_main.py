@@ -7,6 +7,9 @@ from __future__ import print_function
 import json
 import os.path
 import re
+import subprocess
+import sys
+import time
 
 from click.testing import CliRunner
 import html2text
@@ -15,6 +18,7 @@ import xdg.BaseDirectory
 
 import feed2exec.utils as utils
 from feed2exec.__main__ import main
+from feed2exec.model import FeedItemCacheStorage, FeedStateStorage
 from feed2exec.tests.test_feeds import (test_sample, test_nasa)
 
 
@@ -24,6 +28,101 @@ def test_usage():
     assert 0 == result.exit_code
 
 
+#: modules too slow to import for commands that do not fetch feeds
+SLOW_MODULES = ('dateparser', 'cachecontrol', 'lxml', 'pkg_resources', 'requests')
+
+#: maximum time, in seconds, to import the CLI and list feeds
+IMPORT_BUDGET = 0.5
+
+
+def test_import_time(tmpdir):
+    '''make sure simple commands do not load everything'''
+    script = '''
+import sys, time
+start = time.perf_counter()
+from feed2exec.__main__ import main
+main(['--config', sys.argv[1], '--database', sys.argv[2], 'ls'],
+     standalone_mode=False)
+print(time.perf_counter() - start)
+print(' '.join(m for m in sys.argv[3:] if m in sys.modules))
+'''
+    output = subprocess.check_output([sys.executable, '-c', script,
+                                      str(tmpdir.join('feed2exec.ini')),
+                                      str(tmpdir.join('feed2exec.db'))]
+                                     + list(SLOW_MODULES),
+                                     universal_newlines=True)
+    duration, modules = output.split('\n')[:2]
+    assert '' == modules, 'slow modules imported'
+    assert float(duration) < IMPORT_BUDGET, 'import time budget exceeded'
+
+
+def test_status(feed_manager):
+    runner = CliRunner()
+    feed_manager.conf_storage.add(**test_sample)
+    FeedStateStorage(feed_manager.db_path, test_sample['name']).save(
+        failures=10, last_error='404 Client Error', last_failure=100000000, paused='10 failures',
+        last_checked=100000000)
+    result = runner.invoke(main, ['status', '--failing'],
+                           obj={'feed_manager_override': feed_manager})
+    assert 0 == result.exit_code
+    state = json.loads(result.output)
+    assert '10 failures' == state['paused']
+    assert test_sample['url'] == state['url']
+    assert state['last_failure'].startswith('19'), 'dates are readable'
+    assert state['last_checked'].startswith('19')
+    result = runner.invoke(main, ['resume', test_sample['name']],
+                           obj={'feed_manager_override': feed_manager})
+    assert 0 == result.exit_code
+    result = runner.invoke(main, ['status', '--failing'],
+                           obj={'feed_manager_override': feed_manager})
+    assert '' == result.output
+    result = runner.invoke(main, ['resume', 'nonexistent'],
+                           obj={'feed_manager_override': feed_manager})
+    assert 2 == result.exit_code
+
+
+def test_gc(feed_manager):
+    runner = CliRunner()
+    feed_manager.conf_storage.add(**test_sample)
+    feed_manager.conf_storage.add(**test_nasa)
+    FeedStateStorage(feed_manager.db_path, test_sample['name']).save(
+        last_fetch=time.time(), last_checked=time.time())
+    for name in (test_sample['name'], test_nasa['name'], 'gone'):
+        cache = FeedItemCacheStorage(feed_manager.db_path, feed=name)
+        for i in range(5):
+            cache.add('guid-%d' % i)
+    with cache.connection() as con:
+        con.execute('UPDATE feedcache SET last_seen = 0')
+    # still in the feed
+    FeedItemCacheStorage(feed_manager.db_path, feed=test_sample['name']).seen(['guid-0'])
+    expected = {test_sample['name']: 2, 'gone': 3}
+    result = runner.invoke(main, ['gc', '--keep', '2', '--dry-run'],
+                           obj={'feed_manager_override': feed_manager})
+    assert 0 == result.exit_code
+    assert expected == json.loads(result.output)
+    assert 15 == len(list(FeedItemCacheStorage(feed_manager.db_path)))
+    result = runner.invoke(main, ['gc', '--keep', '2'],
+                           obj={'feed_manager_override': feed_manager})
+    assert 0 == result.exit_code
+    assert expected == json.loads(result.output)
+    guids = [row['guid'] for row in FeedItemCacheStorage(feed_manager.db_path, feed=test_sample['name'])]
+    assert ['guid-0', 'guid-3', 'guid-4'] == sorted(guids)
+    assert 5 == len(list(FeedItemCacheStorage(feed_manager.db_path, feed=test_nasa['name']))), \
+        'feeds not fetched recently are kept'
+    assert 2 == len(list(FeedItemCacheStorage(feed_manager.db_path, feed='gone'))), \
+        'latest items of removed feeds are kept'
+    result = runner.invoke(main, ['gc'], obj={'feed_manager_override': feed_manager})
+    assert {} == json.loads(result.output)
+    # e.g. a mistyped --config
+    for name in (test_sample['name'], test_nasa['name']):
+        feed_manager.conf_storage.remove(name)
+    result = runner.invoke(main, ['gc', '--keep', '0', '--max-age', '0'],
+                           obj={'feed_manager_override': feed_manager})
+    assert 0 == result.exit_code
+    assert 'no feed configured' in result.output
+    assert 10 == len(list(FeedItemCacheStorage(feed_manager.db_path)))
+
+
 def test_basics(tmpdir_factory, feed_manager, static_boundary):
     runner = CliRunner()
     result = runner.invoke(main, ['add',
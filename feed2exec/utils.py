@@ -8,7 +8,6 @@ import errno
 import inspect
 import os
 import os.path
-import pkg_resources
 import re
 from unidecode import unidecode
 
@@ -89,6 +88,8 @@ def find_test_file(name='.'):
 
     See also https://pypi.org/project/pytest-datadir/
     """
+    import pkg_resources  # slow, and only needed by the test suite
+
     localpath = os.path.join(os.path.dirname(__file__), 'tests', 'files', name)
     try:
         pkg = pkg_resources.Requirement.parse(__prog__)